@@ -0,0 +1,572 @@
+"""
+Нагрузочный бенчмарк бота
+Поднимает локальный фейковый сервер Emby, заполняет синтетические БД
+на 1k/10k/100k пользователей и замеряет основные сценарии бота:
+импорт Excel, проверку входов, удаление, список пользователей и статистику.
+Если установлен пакет websockets, прием входов через WebSocket проверяется
+на локальном сервере-заглушке
+
+Запуск:
+    python benchmark.py
+    python benchmark.py --sizes 1000,10000 --latency 0.01 --failure-rate 0.02
+    python benchmark.py --output results.json
+    python benchmark.py --compare results.json --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from openpyxl import Workbook
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+WORK_DIR = tempfile.mkdtemp(prefix="emby_bot_bench_")
+os.environ.setdefault('DB_PATH', os.path.join(WORK_DIR, 'bot.db'))
+
+import bot
+from database import AsyncDatabase, Database, to_epoch
+from emby_events import EmbyEventListener
+from emby_api import AsyncEmbyAPI, create_async_client
+from metrics import registry as metrics_registry
+from user_import import create_users, iter_credentials
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_LATENCY = 0.005
+DEFAULT_FAILURE_RATE = 0.0
+DEFAULT_REPEAT = 3
+DEFAULT_IMPORT_ROWS = 1000
+LIST_PAGES = 10
+STATS_CALLS = 20
+WEBSOCKET_SESSIONS = 1000
+WEBSOCKET_TIMEOUT = 30.0
+WEBSOCKET_UNKNOWN_TTL = 0.2
+
+# Доли пользователей синтетической БД по состояниям
+SHARE_PENDING_DUE = 0.2       # еще не входили, пора проверить
+SHARE_PENDING_LATER = 0.2     # еще не входили, проверка позже
+SHARE_ACTIVE = 0.4            # вошли меньше 14 дней назад
+SHARE_EXPIRED = 0.1           # вошли больше 14 дней назад - кандидаты на удаление
+# Остальные уже удалены
+
+
+class FakeEmbyServer:
+    """
+    Локальный HTTP сервер с минимальным подмножеством Emby API
+
+    Каждый запрос задерживается на latency секунд, доля failure_rate
+    запросов завершается ошибкой 500.
+    """
+
+    def __init__(self, latency: float = DEFAULT_LATENCY, failure_rate: float = DEFAULT_FAILURE_RATE):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self._users_body: Optional[bytes] = None
+        self._sorted_users: Optional[List[Dict[str, Any]]] = None
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def load_users(self, users: List[Dict[str, Any]]):
+        """Заменяет список пользователей сервера"""
+        with self._lock:
+            self.users = {user['Id']: user for user in users}
+            self._invalidate()
+
+    def _invalidate(self):
+        self._users_body = None
+        self._sorted_users = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Без TCP_NODELAY заголовки и тело уходят разными пакетами
+                # и ответ ждет delayed ACK клиента (~40 мс)
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def _reply(self, status: int, payload: Any = None, body: Optional[bytes] = None):
+                if body is None:
+                    body = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                data = json.loads(self.rfile.read(length)) if length else None
+                if server.latency:
+                    time.sleep(server.latency)
+
+                url = urlsplit(self.path)
+                path = url.path
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if path == "/emby/System/Info":
+                    self._reply(200, {"ServerName": "fake-emby", "Version": "4.8"})
+                    return
+                if server.failure_rate and random.random() < server.failure_rate:
+                    self._reply(500)
+                    return
+                status, payload, body = server.route(method, path, query, data)
+                self._reply(status, payload, body)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-emby", daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def route(self, method: str, path: str, query: Dict[str, str], data: Any) -> Tuple[int, Any, Optional[bytes]]:
+        """Возвращает (статус, JSON ответа, готовое тело ответа)"""
+        parts = path.strip("/").split("/")
+        with self._lock:
+            if method == "POST" and path == "/emby/Users/New":
+                user = {"Id": uuid.uuid4().hex, "Name": data["Name"], "Policy": {}}
+                self.users[user["Id"]] = user
+                self._invalidate()
+                return 200, user, None
+
+            if method == "GET" and path == "/emby/Users":
+                if self._users_body is None:
+                    self._users_body = json.dumps(list(self.users.values())).encode()
+                return 200, None, self._users_body
+
+            if method == "GET" and path == "/emby/Users/Query":
+                if self._sorted_users is None:
+                    self._sorted_users = sorted(self.users.values(), key=lambda user: user["Name"])
+                users = self._sorted_users
+                prefix = query.get("NameStartsWithOrGreater")
+                if prefix:
+                    users = [user for user in users if user["Name"] >= prefix]
+                start = int(query.get("StartIndex", 0))
+                limit = int(query.get("Limit", len(users)))
+                return 200, {"Items": users[start:start + limit], "TotalRecordCount": len(users)}, None
+
+            if len(parts) < 3 or parts[:2] != ["emby", "Users"] or parts[2] not in self.users:
+                return 404, None, None
+            user_id = parts[2]
+
+            if len(parts) == 3 and method == "GET":
+                return 200, self.users[user_id], None
+            if len(parts) == 3 and method == "DELETE":
+                del self.users[user_id]
+                self._invalidate()
+                return 204, None, None
+            if len(parts) == 4 and parts[3] == "Policy" and method == "POST":
+                self.users[user_id]["Policy"] = data
+                self._invalidate()
+                return 204, None, None
+            if len(parts) == 4 and parts[3] == "Items" and method == "GET":
+                return 200, {"Items": [], "TotalRecordCount": 0}, None
+        return 404, None, None
+
+
+def build_dataset(size: int, db_path: str) -> List[Dict[str, Any]]:
+    """
+    Заполняет БД синтетическими пользователями и возвращает
+    соответствующий им список пользователей Emby
+    """
+    rng = random.Random(size)
+    now = datetime.now(timezone.utc)
+    rows = []
+    emby_users = []
+
+    bounds = []
+    total = 0.0
+    for share in (SHARE_PENDING_DUE, SHARE_PENDING_LATER, SHARE_ACTIVE, SHARE_EXPIRED):
+        total += share
+        bounds.append(int(size * total))
+
+    for i in range(size):
+        username = f"user{i:07d}"
+        emby_id = f"{i:032x}"
+        created_at = now - timedelta(days=60 * rng.random())
+        first_login = None
+        next_check = None
+        attempts = 0
+        is_deleted = 0
+        deleted_at = None
+        last_activity = None
+
+        if i < bounds[0]:
+            # Половина из тех, кого пора проверить, уже вошла в Emby
+            if rng.random() < 0.5:
+                last_activity = now - timedelta(hours=rng.random() * 24)
+        elif i < bounds[1]:
+            attempts = rng.randint(1, 8)
+            next_check = now + timedelta(hours=1 + rng.random() * 23)
+        elif i < bounds[2]:
+            first_login = now - timedelta(days=13 * rng.random())
+            last_activity = first_login
+        elif i < bounds[3]:
+            first_login = now - timedelta(days=15 + 30 * rng.random())
+            last_activity = first_login
+        else:
+            first_login = now - timedelta(days=30 + 30 * rng.random())
+            is_deleted = 1
+            deleted_at = to_epoch(first_login + timedelta(days=14))
+
+        rows.append((
+            username, emby_id, to_epoch(created_at),
+            to_epoch(first_login) if first_login else None,
+            is_deleted, deleted_at, attempts,
+            to_epoch(next_check) if next_check else None
+        ))
+        if not is_deleted:
+            user = {"Id": emby_id, "Name": username, "Policy": {}}
+            if last_activity:
+                user["LastActivityDate"] = last_activity.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+            emby_users.append(user)
+
+    db = Database(db_path)
+    with db.conn:
+        db.conn.executemany('''
+            INSERT INTO emby_users (username, emby_user_id, created_at, first_login_at,
+                                    is_deleted, deleted_at, login_check_attempts, next_login_check_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    db.close()
+    return emby_users
+
+
+def write_import_file(path: str, rows: int, prefix: str):
+    """Создает Excel файл импорта с rows пользователями"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(["user", "pass"])
+    for i in range(rows):
+        sheet.append([f"user{prefix}{i:06d}", f"pass{i}"])
+    workbook.save(path)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Квантиль по методу ближайшего ранга"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class ScenarioResult:
+    """Замеры одного сценария: длительность каждого запуска и число обработанных элементов"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: List[float] = []
+        self.items = 0
+
+    def add(self, seconds: float, items: int):
+        self.samples.append(seconds)
+        self.items += items
+
+    def summary(self) -> Dict[str, float]:
+        total = sum(self.samples)
+        return {
+            "runs": len(self.samples),
+            "items": self.items,
+            "throughput": self.items / total if total else 0.0,
+            "p50_ms": percentile(self.samples, 0.5) * 1000,
+            "p99_ms": percentile(self.samples, 0.99) * 1000,
+        }
+
+
+class Benchmark:
+    """Прогоняет сценарии бота на синтетической БД одного размера"""
+
+    def __init__(self, server: FakeEmbyServer, size: int, args: argparse.Namespace):
+        self.server = server
+        self.size = size
+        self.args = args
+        self.template_path = os.path.join(WORK_DIR, f"template_{size}.db")
+        self.db_path = os.path.join(WORK_DIR, f"run_{size}.db")
+        self.emby_users: List[Dict[str, Any]] = []
+        self.context = SimpleNamespace(bot=SimpleNamespace(send_message=self._send_message))
+
+    @staticmethod
+    async def _send_message(chat_id: int, text: str, **kwargs):
+        return None
+
+    def prepare(self):
+        """Создает шаблонную БД, которая копируется перед каждым запуском"""
+        for path in (self.template_path, self.db_path):
+            if os.path.exists(path):
+                os.remove(path)
+        started = time.perf_counter()
+        self.emby_users = build_dataset(self.size, self.template_path)
+        print(f"  синтетическая БД: {self.size} пользователей за {time.perf_counter() - started:.1f} с")
+
+    async def fresh_db(self) -> AsyncDatabase:
+        """Восстанавливает БД и сервер Emby в исходное состояние"""
+        if bot.db is not None:
+            await bot.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+        shutil.copyfile(self.template_path, self.db_path)
+        bot.db = AsyncDatabase(Database(self.db_path))
+        self.server.load_users([dict(user) for user in self.emby_users])
+        return bot.db
+
+    async def run(self) -> Dict[str, ScenarioResult]:
+        results = {}
+        for name, scenario in (
+            ("import_excel", self.bench_import),
+            ("check_user_logins", self.bench_check_user_logins),
+            ("check_and_delete_users", self.bench_check_and_delete_users),
+            ("list_users", self.bench_list_users),
+            ("stats", self.bench_stats),
+            ("websocket_logins", self.bench_websocket_logins),
+        ):
+            if name == "websocket_logins" and websockets is None:
+                continue
+            result = ScenarioResult(name)
+            for attempt in range(self.args.repeat):
+                db = await self.fresh_db()
+                await scenario(db, result, attempt)
+            results[name] = result
+        return results
+
+    async def bench_import(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        path = os.path.join(WORK_DIR, f"import_{self.size}_{attempt}.xlsx")
+        write_import_file(path, self.args.import_rows, f"import{attempt}")
+        started = time.perf_counter()
+        rows = await create_users(
+            bot.emby_api, db, iter_credentials(path), concurrency=bot.IMPORT_CONCURRENCY
+        )
+        result.add(time.perf_counter() - started, len(rows))
+        os.remove(path)
+
+    async def bench_check_user_logins(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        due = len(await db.get_due_login_checks(limit=bot.LOGIN_CHECK_BATCH))
+        started = time.perf_counter()
+        await bot.check_user_logins(self.context)
+        result.add(time.perf_counter() - started, due)
+
+    async def bench_check_and_delete_users(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        expired = len(await db.get_users_to_delete(days=14))
+        started = time.perf_counter()
+        await bot.check_and_delete_users(self.context)
+        result.add(time.perf_counter() - started, expired)
+
+    async def bench_list_users(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        for status in bot.USER_STATUS_TITLES:
+            cursor = None
+            for _ in range(LIST_PAGES):
+                started = time.perf_counter()
+                _, markup = await bot.build_users_page(status, cursor, False)
+                result.add(time.perf_counter() - started, 1)
+                next_data = [
+                    button.callback_data for row in markup.inline_keyboard for button in row
+                    if button.callback_data.startswith(f"list_users|{status}|n|")
+                ]
+                if not next_data:
+                    break
+                parts = next_data[0].split("|")
+                cursor = (int(parts[3]), int(parts[4]))
+
+    async def bench_stats(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        for _ in range(STATS_CALLS):
+            started = time.perf_counter()
+            await db.get_user_stats()
+            result.add(time.perf_counter() - started, 1)
+
+    async def bench_websocket_logins(self, db: AsyncDatabase, result: ScenarioResult, attempt: int):
+        """
+        Заглушка WebSocket Emby присылает сессии ожидающих пользователей и одного,
+        которого еще нет в БД; его вход должен записаться со следующим сообщением,
+        когда пользователь появится в БД
+        """
+        pending = (await db.get_pending_login_users())[:WEBSOCKET_SESSIONS]
+        activity = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+        late_name, late_id = f"userlate{attempt}", uuid.uuid4().hex
+        sessions = [{"UserId": emby_id, "LastActivityDate": activity} for _, emby_id in pending]
+        sessions.append({"UserId": late_id, "LastActivityDate": activity})
+        
+        recorded = set()
+        progress = asyncio.Event()
+        late_added = asyncio.Event()
+        
+        async def on_login(emby_id: str, login_time: datetime) -> bool:
+            ok = await bot.record_first_login(emby_id, login_time)
+            if ok:
+                recorded.add(emby_id)
+                progress.set()
+            return ok
+        
+        async def wait_for(count: int):
+            while len(recorded) < count:
+                progress.clear()
+                await progress.wait()
+        
+        async def handler(ws):
+            await ws.send(json.dumps({"MessageType": "Sessions", "Data": sessions}))
+            await late_added.wait()
+            # Повтор раньше unknown_ttl слушатель пропустил бы без обращения к БД
+            await asyncio.sleep(WEBSOCKET_UNKNOWN_TTL)
+            await ws.send(json.dumps({"MessageType": "Sessions", "Data": sessions[-1:]}))
+            await ws.wait_closed()
+        
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            listener = EmbyEventListener(f"ws://127.0.0.1:{port}", on_login=on_login, unknown_ttl=WEBSOCKET_UNKNOWN_TTL)
+            started = time.perf_counter()
+            listener.start()
+            try:
+                await asyncio.wait_for(wait_for(len(pending)), WEBSOCKET_TIMEOUT)
+                await db.add_emby_user(late_name, late_id)
+                late_added.set()
+                await asyncio.wait_for(wait_for(len(pending) + 1), WEBSOCKET_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"  ❌ websocket_logins: записано {len(recorded)} из {len(pending) + 1} входов")
+            finally:
+                await listener.stop()
+        result.add(time.perf_counter() - started, len(recorded))
+
+
+def print_report(size: int, results: Dict[str, ScenarioResult]):
+    print(f"\n  {'сценарий':<24}{'запусков':>9}{'элементов':>11}{'в секунду':>12}{'p50, мс':>11}{'p99, мс':>11}")
+    for name, result in results.items():
+        s = result.summary()
+        print(f"  {name:<24}{s['runs']:>9}{s['items']:>11}{s['throughput']:>12.1f}{s['p50_ms']:>11.2f}{s['p99_ms']:>11.2f}")
+
+    print(f"\n  {'операция':<40}{'вызовов':>9}{'ошибок':>8}{'p50, мс':>10}{'p99, мс':>10}")
+    for component, operation, calls, errors, avg, p50, p99 in metrics_registry.snapshot():
+        if component in ("emby", "db", "job"):
+            print(f"  {component + '.' + operation:<40}{calls:>9}{errors:>8}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+
+
+def compare(current: Dict[str, Dict[str, Dict[str, float]]], baseline_path: str, tolerance: float) -> List[str]:
+    """Возвращает сценарии, пропускная способность которых упала больше чем на tolerance"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for size, scenarios in current.items():
+        for name, summary in scenarios.items():
+            previous = baseline.get(size, {}).get(name)
+            if not previous or not previous["throughput"]:
+                continue
+            change = summary["throughput"] / previous["throughput"] - 1
+            if change < -tolerance:
+                regressions.append(
+                    f"{name} ({size}): {previous['throughput']:.1f} -> {summary['throughput']:.1f} в секунду ({change:+.0%})"
+                )
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    server = FakeEmbyServer(args.latency, args.failure_rate)
+    server.start()
+    bot.emby_api = AsyncEmbyAPI(server.url, "benchmark", client=create_async_client())
+    await bot.db.close()
+    bot.db = None
+
+    print(f"🏁 Фейковый Emby: {server.url}, задержка {args.latency * 1000:.0f} мс, ошибок {args.failure_rate:.0%}")
+    all_results = {}
+    try:
+        for size in args.sizes:
+            print(f"\n📦 {size} пользователей")
+            benchmark = Benchmark(server, size, args)
+            benchmark.prepare()
+            metrics_registry.reset()
+            results = await benchmark.run()
+            print_report(size, results)
+            all_results[str(size)] = {name: result.summary() for name, result in results.items()}
+    finally:
+        await bot.emby_api.close()
+        if bot.db is not None:
+            await bot.db.close()
+        server.stop()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "latency": args.latency,
+                "failure_rate": args.failure_rate,
+                "results": all_results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.output}")
+
+    if args.compare:
+        regressions = compare(all_results, args.compare, args.tolerance)
+        if regressions:
+            print("\n❌ Падение производительности:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\n✅ Падения производительности больше {args.tolerance:.0%} нет")
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк бота на фейковом сервере Emby")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Размеры синтетических БД через запятую")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY,
+                        help="Задержка ответа фейкового Emby в секундах")
+    parser.add_argument("--failure-rate", type=float, default=DEFAULT_FAILURE_RATE,
+                        help="Доля запросов, завершающихся ошибкой 500")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Сколько раз повторять каждый сценарий")
+    parser.add_argument("--import-rows", type=int, default=DEFAULT_IMPORT_ROWS,
+                        help="Строк в файле импорта")
+    parser.add_argument("--output", help="Сохранить результаты в JSON файл")
+    parser.add_argument("--compare", help="Сравнить с сохраненными результатами")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Допустимое падение пропускной способности при сравнении")
+    parser.add_argument("--verbose", action="store_true", help="Показывать логи бота")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+    return args
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if not arguments.verbose:
+        logging.disable(logging.ERROR)
+    sys.exit(asyncio.run(main(arguments)))
@@ -3,12 +3,16 @@
 """
 
 import os
+import json
 import logging
+import functools
+import time
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Tuple
 import asyncio
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -17,10 +21,27 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
-from openpyxl import load_workbook
 
-from database import Database
-from emby_api import EmbyAPI
+from database import AsyncDatabase, Database, DEFAULT_DB_READERS, USER_STATUS_FILTERS, from_epoch
+from metrics import registry as metrics_registry, timed
+from emby_events import EmbyEventListener, build_websocket_url
+from notifications import NotificationDispatcher, split_message
+from user_import import create_users, iter_credentials, ImportRowResult, MissingColumnsError, DEFAULT_CONCURRENCY
+from emby_api import (
+    AsyncEmbyAPI,
+    CircuitBreaker,
+    POLICY_FAILED,
+    POLICY_UPDATED,
+    create_async_client,
+    parse_emby_date,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_KEEPALIVE_EXPIRY,
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_RECOVERY_TIMEOUT,
+    DEFAULT_MAX_RETRIES
+)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,15 +49,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db = Database()
+db = AsyncDatabase(
+    Database(os.getenv('DB_PATH', 'emby_bot.db')),
+    readers=int(os.getenv('DB_READERS', DEFAULT_DB_READERS))
+)
 emby_api = None
+emby_events = None
+import_tasks = set()
+
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', DEFAULT_CONCURRENCY))
+NOTIFY_DIGEST = os.getenv('NOTIFY_DIGEST', '0') == '1'
+DELETE_CONCURRENCY = int(os.getenv('DELETE_CONCURRENCY', 5))
+POLICY_CONCURRENCY = int(os.getenv('POLICY_CONCURRENCY', 8))
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', 21600))
+RECONCILE_CHECK_CONCURRENCY = 10
+IMPORT_DIR = os.getenv('IMPORT_DIR', 'imports')
+IMPORT_RESUME_RETRY_DELAY = 60
+
+# Адаптивная проверка входов: как часто запускать, сколько пользователей брать за раз,
+# с какого количества переходить на снимок списка и сколько запросов выполнять параллельно
+LOGIN_POLL_INTERVAL = int(os.getenv('LOGIN_POLL_INTERVAL', 300))
+LOGIN_CHECK_BATCH = 1000
+LOGIN_SNAPSHOT_THRESHOLD = 50
+LOGIN_CHECK_CONCURRENCY = 10
+
+# Экспорт метрик: HTTP эндпоинт /metrics и/или файл для textfile collector
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_FILE_INTERVAL = 60
 
 
 def require_admin(func):
     """Декоратор для проверки прав администратора"""
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             if update.message:
                 await update.message.reply_text("❌ У вас нет прав администратора")
             elif update.callback_query:
@@ -46,12 +95,13 @@ def require_admin(func):
     return wrapper
 
 
+@timed("handler")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
     username = update.effective_user.username
     
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await update.message.reply_text(
             "❌ У вас нет доступа к этому боту. Бот доступен только для администраторов."
         )
@@ -86,6 +136,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@timed("handler")
 @require_admin
 async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавляет администратора"""
@@ -100,7 +151,7 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         telegram_id = int(context.args[0])
         username = context.args[1] if len(context.args) > 1 else None
         
-        if db.add_admin(telegram_id, username):
+        if await db.add_admin(telegram_id, username):
             await update.message.reply_text(f"✅ Администратор {telegram_id} добавлен")
         else:
             await update.message.reply_text(f"⚠️ Администратор {telegram_id} уже существует")
@@ -108,6 +159,7 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный формат Telegram ID")
 
 
+@timed("handler")
 @require_admin
 async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаляет администратора"""
@@ -121,7 +173,7 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         telegram_id = int(context.args[0])
         
-        if db.remove_admin(telegram_id):
+        if await db.remove_admin(telegram_id):
             await update.message.reply_text(f"✅ Администратор {telegram_id} удален")
         else:
             await update.message.reply_text(f"⚠️ Администратор {telegram_id} не найден")
@@ -129,6 +181,7 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный формат Telegram ID")
 
 
+@timed("handler")
 @require_admin
 async def add_admin_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавляет группу администраторов"""
@@ -142,7 +195,7 @@ async def add_admin_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         group_id = int(context.args[0])
         
-        if db.add_admin_group(group_id):
+        if await db.add_admin_group(group_id):
             await update.message.reply_text(f"✅ Группа {group_id} добавлена")
         else:
             await update.message.reply_text(f"⚠️ Группа {group_id} уже существует")
@@ -150,70 +203,223 @@ async def add_admin_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный формат ID группы")
 
 
+@timed("handler")
+@require_admin
+async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает статистику просмотра пользователя"""
+    if len(context.args) < 1:
+        await update.message.reply_text(
+            "⚠️ Использование: /user_stats <имя пользователя>\n"
+            "Пример: /user_stats user1"
+        )
+        return
+    
+    username = context.args[0]
+    user = await db.get_user_by_username(username)
+    if not user:
+        await update.message.reply_text(f"⚠️ Пользователь {username} не найден")
+        return
+    
+    stats = await emby_api.get_user_playback_stats(user[1])
+    
+    text = f"📊 Статистика просмотра {username}\n\n"
+    text += f"▶️ Всего просмотрено: {stats['total_items_played']}\n"
+    text += f"🎬 Фильмов: {stats['movies']}\n"
+    text += f"📺 Эпизодов: {stats['episodes']}\n"
+    
+    if stats['recent_items']:
+        text += "\n🕒 Последние просмотры:\n"
+        for item in stats['recent_items']:
+            played = ""
+            played_date = parse_emby_date(item['played_date'])
+            if played_date:
+                played = f" ({played_date.strftime('%d.%m.%Y')})"
+            text += f"• {item['name']}{played}\n"
+    
+    await update.message.reply_text(text)
+
+
+def parse_policy_updates(args: List[str]) -> dict:
+    """
+    Разбирает аргументы вида Ключ=значение в изменения политики
+    
+    Значения читаются как JSON (true, 5, ["a", "b"]), иначе остаются строкой.
+    """
+    updates = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or not key:
+            raise ValueError(arg)
+        try:
+            updates[key] = json.loads(value)
+        except ValueError:
+            updates[key] = value
+    return updates
+
+
+@timed("handler")
+@require_admin
+async def bulk_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет политику всех пользователей 'user*' с заданным статусом"""
+    statuses = ", ".join(status for status in USER_STATUS_FILTERS if status != "deleted")
+    usage = (
+        "⚠️ Использование: /bulk_policy <статус> <Ключ=значение> ...\n"
+        f"Статусы: {statuses}\n"
+        "Пример: /bulk_policy active IsDisabled=true EnableContentDownloading=false"
+    )
+    if len(context.args) < 2 or context.args[0] not in USER_STATUS_FILTERS or context.args[0] == "deleted":
+        await update.message.reply_text(usage)
+        return
+    
+    try:
+        policy_updates = parse_policy_updates(context.args[1:])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Неверный аргумент: {e}\n\n{usage}")
+        return
+    
+    status = context.args[0]
+    emby_ids = await db.get_emby_user_ids(status)
+    users = [user for user in await emby_api.get_users_starting_with_user() if user.get('Id') in emby_ids]
+    if not users:
+        await update.message.reply_text("📋 Пользователей не найдено")
+        return
+    
+    status_message = await update.message.reply_text(f"⏳ Обновляю политику {len(users)} пользователей...")
+    results = await emby_api.bulk_update_policy(policy_updates, users, concurrency=POLICY_CONCURRENCY)
+    
+    names = {user.get('Id'): user.get('Name') for user in users}
+    updated = sum(1 for result in results.values() if result == POLICY_UPDATED)
+    failed = [names[user_id] for user_id, result in results.items() if result == POLICY_FAILED]
+    
+    text = f"🛡 Политика обновлена ({status})\n\n"
+    text += f"✅ Обновлено: {updated}\n"
+    text += f"➖ Без изменений: {len(results) - updated - len(failed)}\n"
+    if failed:
+        text += f"❌ Ошибок: {len(failed)}\n\n"
+        text += "Детали:\n" + "\n".join(f"❌ {name}" for name in failed[:10])
+        if len(failed) > 10:
+            text += f"\n... и еще {len(failed) - 10} ошибок"
+    
+    await status_message.edit_text(text)
+
+
+@timed("handler")
+@require_admin
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает число вызовов, ошибок и задержки операций с момента запуска"""
+    rows = metrics_registry.snapshot()
+    if not rows:
+        await update.message.reply_text("📈 Метрик пока нет")
+        return
+    
+    text = "📈 Метрики с момента запуска\n"
+    text += "вызовы / ошибки / среднее / p50 / p99, мс\n"
+    component = None
+    for row_component, operation, calls, errors, avg, p50, p99 in rows:
+        if row_component != component:
+            component = row_component
+            text += f"\n[{component}]\n"
+        text += f"• {operation}: {calls} / {errors} / {avg * 1000:.0f} / {p50 * 1000:.0f} / {p99 * 1000:.0f}\n"
+    
+    for chunk in split_message(text):
+        await update.message.reply_text(chunk)
+
+
+@timed("handler")
 @require_admin
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик загруженных документов (Excel файлов)"""
+    """
+    Обработчик загруженных документов (Excel и CSV файлов)
+    
+    Файл сохраняется в IMPORT_DIR и регистрируется как задание импорта,
+    которое выполняется в фоне и продолжается после перезапуска бота.
+    """
     document = update.message.document
     
-    if not (document.file_name.endswith('.xlsx') or document.file_name.endswith('.xls')):
-        await update.message.reply_text("❌ Пожалуйста, загрузите Excel файл (.xlsx или .xls)")
+    if not document.file_name.lower().endswith(('.xlsx', '.xls', '.csv')):
+        await update.message.reply_text("❌ Пожалуйста, загрузите Excel файл (.xlsx или .xls) или CSV файл (.csv)")
         return
     
-    await update.message.reply_text("📥 Загружаю файл...")
+    status_message = await update.message.reply_text("📥 Загружаю файл...")
+    
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    job_id, file_path = await db.create_import_job(document.file_name, IMPORT_DIR, update.effective_chat.id)
+    try:
+        file = await context.bot.get_file(document.file_id)
+        await file.download_to_drive(file_path)
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки файла импорта {job_id}: {e}")
+        await db.finish_import_job(job_id, 'failed')
+        await status_message.edit_text(f"❌ Не удалось загрузить файл: {e}")
+        return
     
-    file = await context.bot.get_file(document.file_id)
-    file_path = f"temp_{document.file_name}"
-    await file.download_to_drive(file_path)
+    start_import_job(context.bot, job_id, file_path, update.effective_chat.id, status_message)
+
+
+def start_import_job(bot: Bot, job_id: int, file_path: str, chat_id: int, status_message=None, resume: bool = False):
+    """Запускает задание импорта в фоновой задаче (ссылка хранится до ее завершения)"""
+    task = asyncio.create_task(run_import_job(bot, job_id, file_path, chat_id, status_message, resume))
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+
+
+async def run_import_job(bot: Bot, job_id: int, file_path: str, chat_id: int, status_message=None, resume: bool = False):
+    """
+    Выполняет задание импорта и отправляет отчет
     
+    Уже обработанные строки задания пропускаются. При продолжении после
+    перезапуска берется снимок пользователей Emby: строки, отправленные
+    в Emby перед остановкой, но не успевшие записаться, не создаются повторно.
+    Пока снимок получить не удается, задание ждет и повторяет попытку.
+    Если бот останавливается во время импорта, задание остается незавершенным.
+    """
     try:
-        workbook = load_workbook(file_path)
-        sheet = workbook.active
+        if status_message is None:
+            status_message = await bot.send_message(chat_id, f"🔁 Продолжаю импорт (задание {job_id})...")
         
-        user_col = None
-        pass_col = None
+        skipped = []
+        credentials = iter_credentials(file_path, skipped)
+        completed = {row[0]: ImportRowResult(*row) for row in await db.get_import_rows(job_id)}
+        existing = None
+        if resume:
+            # Без снимка строки, отправленные до остановки, создавались бы повторно
+            # и отмечались ошибкой, поэтому задание ждет, пока Emby ответит
+            snapshot = await emby_api.get_user_name_map()
+            if snapshot is None:
+                await status_message.edit_text(
+                    f"⏳ Emby недоступен, импорт (задание {job_id}) продолжится автоматически"
+                )
+            while snapshot is None:
+                logger.warning(f"⚠️ Emby недоступен, продолжение импорта {job_id} через {IMPORT_RESUME_RETRY_DELAY} с")
+                await asyncio.sleep(IMPORT_RESUME_RETRY_DELAY)
+                snapshot = await emby_api.get_user_name_map()
+            existing = {name: emby_id for emby_id, name in snapshot.items()}
+            logger.info(f"🔁 Продолжение импорта {job_id}: уже обработано {len(completed)} строк")
         
-        for col in range(1, sheet.max_column + 1):
-            header = str(sheet.cell(1, col).value).lower() if sheet.cell(1, col).value else ""
-            if header == "user":
-                user_col = col
-            elif header == "pass":
-                pass_col = col
-        
-        if user_col is None or pass_col is None:
-            await update.message.reply_text(
-                "❌ Не найдены колонки 'user' и 'pass' в Excel файле.\n"
-                "Убедитесь, что первая строка содержит заголовки 'user' и 'pass'"
+        async def report_progress(done: int, created: int, failed: int):
+            await status_message.edit_text(
+                f"⏳ Создание пользователей: обработано {done}\n"
+                f"✅ Создано: {created}\n"
+                f"❌ Ошибок: {failed}"
             )
-            os.remove(file_path)
-            return
         
-        created = 0
-        errors = 0
-        error_messages = []
+        results = await create_users(
+            emby_api,
+            db,
+            credentials,
+            concurrency=IMPORT_CONCURRENCY,
+            on_progress=report_progress,
+            job_id=job_id,
+            completed=completed,
+            existing=existing
+        )
         
-        for row in range(2, sheet.max_row + 1):
-            username = sheet.cell(row, user_col).value
-            password = sheet.cell(row, pass_col).value
-            
-            if not username or not password:
-                continue
-            
-            username = str(username).strip()
-            password = str(password).strip()
-            
-            if not username.startswith("user"):
-                error_messages.append(f"⚠️ Пропущен {username} (имя не начинается с 'user')")
-                errors += 1
-                continue
-            
-            user_data = emby_api.create_user(username, password)
-            if user_data:
-                emby_user_id = user_data.get('Id')
-                db.add_emby_user(username, emby_user_id)
-                created += 1
-                logger.info(f"✅ Создан пользователь {username}")
-            else:
-                error_messages.append(f"❌ Ошибка создания {username}")
+        error_messages = [f"⚠️ Пропущен {username} (имя не начинается с 'user')" for username in skipped]
+        errors = len(skipped)
+        created = sum(1 for r in results if r.ok)
+        for r in results:
+            if not r.ok:
+                error_messages.append(f"❌ Ошибка создания {r.username}")
                 errors += 1
         
         report = f"📊 Результаты создания пользователей:\n\n"
@@ -224,24 +430,103 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if len(error_messages) > 10:
                 report += f"\n... и еще {len(error_messages) - 10} ошибок"
         
-        await update.message.reply_text(report)
-        
-        os.remove(file_path)
-        
+        await db.finish_import_job(job_id)
+        await bot.send_message(chat_id, report)
+    
+    except MissingColumnsError:
+        await db.finish_import_job(job_id, 'failed')
+        await bot.send_message(
+            chat_id,
+            "❌ Не найдены колонки 'user' и 'pass' в файле.\n"
+            "Убедитесь, что первая строка содержит заголовки 'user' и 'pass'"
+        )
+    
     except Exception as e:
-        logger.error(f"Ошибка при обработке Excel файла: {e}")
-        await update.message.reply_text(f"❌ Ошибка при обработке файла: {str(e)}")
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        logger.error(f"Ошибка при обработке файла импорта: {e}")
+        await db.finish_import_job(job_id, 'failed')
+        await bot.send_message(chat_id, f"❌ Ошибка при обработке файла: {str(e)}")
+    
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+async def resume_import_jobs(bot: Bot):
+    """Продолжает задания импорта, прерванные остановкой бота"""
+    for job_id, file_name, file_path, chat_id in await db.get_unfinished_import_jobs():
+        if not os.path.exists(file_path):
+            logger.error(f"❌ Файл задания импорта {job_id} не найден: {file_path}")
+            await db.finish_import_job(job_id, 'failed')
+            continue
+        logger.info(f"🔁 Продолжаю задание импорта {job_id}: {file_name}")
+        start_import_job(bot, job_id, file_path, chat_id, resume=True)
+
+
+USERS_PAGE_SIZE = 20
+
+USER_STATUS_TITLES = {
+    "all": "Все",
+    "active": "Активные",
+    "pending": "Ждут входа",
+    "logged_in": "Входили",
+    "deleted": "Удаленные",
+}
+
+
+async def build_users_page(status: str, cursor, backward: bool):
+    """
+    Формирует страницу списка пользователей с кнопками фильтров и листания
+    
+    В callback_data кнопок листания передается курсор (created_at, id)
+    крайней строки страницы: list_users|<фильтр>|<n или p>|<created_at>|<id>
+    """
+    if status not in USER_STATUS_TITLES:
+        status = "all"
+    
+    users, has_more = await db.get_users_page(status, cursor, backward, limit=USERS_PAGE_SIZE)
+    
+    if users:
+        text = f"👥 Список пользователей ({USER_STATUS_TITLES[status]}):\n\n"
+        for user_row_id, username, emby_id, first_login, is_deleted, created_at in users:
+            status_icon = "❌" if is_deleted else "✅"
+            login_info = ""
+            if first_login:
+                login_info = f" | Вход: {from_epoch(first_login).strftime('%d.%m.%Y')}"
+            text += f"{status_icon} {username}{login_info}\n"
+    else:
+        text = "📋 Пользователей не найдено"
+    
+    has_prev = has_more if backward else cursor is not None
+    has_next = cursor is not None if backward else has_more
+    
+    navigation = []
+    if users and has_prev:
+        first = users[0]
+        navigation.append(InlineKeyboardButton("⬅️ Предыдущие", callback_data=f"list_users|{status}|p|{first[5]}|{first[0]}"))
+    if users and has_next:
+        last = users[-1]
+        navigation.append(InlineKeyboardButton("Следующие ➡️", callback_data=f"list_users|{status}|n|{last[5]}|{last[0]}"))
+    
+    filter_buttons = [
+        InlineKeyboardButton(("• " if key == status else "") + title, callback_data=f"list_users|{key}")
+        for key, title in USER_STATUS_TITLES.items()
+    ]
+    
+    keyboard = [filter_buttons[:2], filter_buttons[2:4], filter_buttons[4:]]
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+    
+    return text, InlineKeyboardMarkup(keyboard)
 
 
+@timed("handler")
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на inline кнопки"""
     query = update.callback_query
     await query.answer()
     
     user_id = query.from_user.id
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await query.edit_message_text("❌ У вас нет прав администратора")
         return
     
@@ -250,66 +535,50 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "upload_excel":
         await query.edit_message_text(
             "📤 Загрузка Excel файла\n\n"
-            "Отправьте Excel файл (.xlsx или .xls) со следующей структурой:\n\n"
+            "Отправьте Excel файл (.xlsx или .xls) или CSV файл со следующей структурой:\n\n"
             "Колонка 'user' - имена пользователей (должны начинаться с 'user')\n"
             "Колонка 'pass' - пароли пользователей\n\n"
             "Первая строка должна содержать заголовки."
         )
     
     elif data == "stats":
-        users = db.get_all_users()
-        active_users = [u for u in users if not u[3]]
-        users_with_login = [u for u in users if u[2] is not None]
+        stats = await db.get_user_stats(days=7)
         
         text = f"📊 Общая статистика\n\n"
-        text += f"👥 Всего пользователей: {len(users)}\n"
-        text += f"✅ Активных: {len(active_users)}\n"
-        text += f"🚪 Входили: {len(users_with_login)}\n"
-        text += f"❌ Удалено: {len(users) - len(active_users)}\n"
-        
-        await query.edit_message_text(text)
-    
-    elif data == "list_users":
-        users = db.get_all_users()
-        
-        if not users:
-            await query.edit_message_text("📋 Пользователей не найдено")
-            return
-        
-        text = "👥 Список пользователей:\n\n"
-        for i, (username, emby_id, first_login, is_deleted) in enumerate(users[:20], 1):
-            status = "❌" if is_deleted else "✅"
-            login_info = ""
-            if first_login:
-                login_date = datetime.fromisoformat(first_login) if isinstance(first_login, str) else first_login
-                login_info = f" | Вход: {login_date.strftime('%d.%m.%Y')}"
-            text += f"{i}. {status} {username}{login_info}\n"
+        text += f"👥 Всего пользователей: {stats['total']}\n"
+        text += f"✅ Активных: {stats['active']}\n"
+        text += f"🚪 Входили: {stats['logged_in']}\n"
+        text += f"⏳ Ждут первого входа: {stats['pending']}\n"
+        text += f"❌ Удалено: {stats['deleted']}\n"
         
-        if len(users) > 20:
-            text += f"\n... и еще {len(users) - 20} пользователей"
+        if stats['daily']:
+            text += "\n📅 За последние 7 дней (создано / входов / удалено):\n"
+            for day, counts in stats['daily'].items():
+                day_label = datetime.strptime(day, "%Y-%m-%d").strftime("%d.%m")
+                text += f"{day_label}: {counts['created']} / {counts['logins']} / {counts['deleted']}\n"
         
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(text, reply_markup=reply_markup)
     
+    elif data == "list_users" or data.startswith("list_users|"):
+        parts = data.split("|")
+        status = parts[1] if len(parts) > 1 else "all"
+        cursor = (int(parts[3]), int(parts[4])) if len(parts) > 4 else None
+        backward = len(parts) > 2 and parts[2] == "p"
+        
+        text, reply_markup = await build_users_page(status, cursor, backward)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
     elif data == "check_logins":
         await query.edit_message_text("🔍 Проверяю первые входы пользователей...")
         
-        users = db.get_all_users()
-        checked = 0
-        updated = 0
-        
-        for username, emby_id, first_login, is_deleted in users:
-            if is_deleted or first_login:
-                continue
-            
-            login_time = emby_api.check_user_first_login(emby_id)
-            if login_time:
-                db.update_first_login(emby_id, login_time)
-                updated += 1
-            
-            checked += 1
+        result = await sweep_first_logins()
+        if result is None:
+            await query.edit_message_text("❌ Не удалось получить список пользователей Emby")
+            return
+        checked, updated = result
         
         await query.edit_message_text(
             f"✅ Проверка завершена\n\n"
@@ -318,8 +587,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "manage_admins":
-        admins = db.get_all_admins()
-        groups = db.get_all_admin_groups()
+        admins = await db.get_all_admins()
+        groups = await db.get_all_admin_groups()
         
         text = "👨‍💼 Управление администраторами\n\n"
         text += f"Администраторов: {len(admins)}\n"
@@ -328,6 +597,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += "/add_admin <id> - добавить админа\n"
         text += "/remove_admin <id> - удалить админа\n"
         text += "/add_admin_group <id> - добавить группу\n"
+        text += "/user_stats <имя> - статистика просмотра\n"
+        text += "/bulk_policy <статус> <Ключ=значение> - политика для группы\n"
+        text += "/reconcile - сверить БД с Emby\n"
+        text += "/metrics - задержки и ошибки\n"
         
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -335,7 +608,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, reply_markup=reply_markup)
     
     elif data == "settings":
-        connection_status = "✅ Подключено" if emby_api.test_connection() else "❌ Нет подключения"
+        connection_status = "✅ Подключено" if await emby_api.test_connection() else "❌ Нет подключения"
         
         text = f"⚙️ Настройки\n\n"
         text += f"Emby сервер: {connection_status}\n"
@@ -370,6 +643,64 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+async def delete_expired_users(context: ContextTypes.DEFAULT_TYPE, users: List[Tuple[str, str, int]]):
+    """
+    Удаляет пользователей из Emby параллельно (не более DELETE_CONCURRENCY запросов),
+    отмечает удаленных в БД, ставит неудачные удаления в очередь повторов
+    и уведомляет администраторов
+    """
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+    
+    async def delete(user: Tuple[str, str, int]) -> bool:
+        async with semaphore:
+            return await emby_api.delete_user(user[1])
+    
+    results = await asyncio.gather(*(delete(user) for user in users))
+    
+    deleted_users = [user for user, ok in zip(users, results) if ok]
+    failed_users = [user for user, ok in zip(users, results) if not ok]
+    
+    if deleted_users:
+        await db.mark_users_deleted(emby_user_id for _, emby_user_id, _ in deleted_users)
+        await db.clear_deletion_retries(emby_user_id for _, emby_user_id, _ in deleted_users)
+    
+    if failed_users:
+        await db.schedule_deletion_retries(
+            (emby_user_id, "ошибка удаления в Emby") for _, emby_user_id, _ in failed_users
+        )
+        logger.warning(f"⚠️ Не удалось удалить {len(failed_users)} пользователей, запланирован повтор")
+    
+    if not deleted_users:
+        return
+    
+    admins = await db.get_all_admins()
+    admin_groups = await db.get_all_admin_groups()
+    
+    dispatcher = NotificationDispatcher(context.bot)
+    recipients = admins + admin_groups
+    
+    for username, emby_user_id, first_login_at in deleted_users:
+        first_login_date = from_epoch(first_login_at)
+        if NOTIFY_DIGEST:
+            notification = f"• {username} (первый вход: {first_login_date.strftime('%d.%m.%Y %H:%M')})"
+        else:
+            notification = (
+                f"🗑 Пользователь удален\n\n"
+                f"Имя: {username}\n"
+                f"Первый вход: {first_login_date.strftime('%d.%m.%Y %H:%M')}\n"
+                f"Причина: Прошло 14 дней с первого входа"
+            )
+        dispatcher.add_many(recipients, notification)
+        logger.info(f"✅ Пользователь {username} удален")
+    
+    await dispatcher.flush(
+        digest=NOTIFY_DIGEST,
+        digest_title=f"🗑 Удалено пользователей: {len(deleted_users)}\nПричина: Прошло 14 дней с первого входа",
+        digest_separator="\n"
+    )
+
+
+@timed("job")
 async def check_and_delete_users(context: ContextTypes.DEFAULT_TYPE):
     """
     Фоновая задача: проверяет пользователей и удаляет тех,
@@ -381,9 +712,13 @@ async def check_and_delete_users(context: ContextTypes.DEFAULT_TYPE):
         logger.error("❌ Emby API не инициализирован")
         return
     
+    if emby_api.breaker.is_open():
+        logger.warning("⚠️ Emby недоступен, проверка пользователей для удаления пропущена")
+        return
+    
     logger.info("🔍 Запуск проверки пользователей для удаления...")
     
-    users_to_delete = db.get_users_to_delete(days=14)
+    users_to_delete = await db.get_users_to_delete(days=14)
     
     if not users_to_delete:
         logger.info("✅ Нет пользователей для удаления")
@@ -391,45 +726,152 @@ async def check_and_delete_users(context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"📋 Найдено {len(users_to_delete)} пользователей для удаления")
     
-    admins = db.get_all_admins()
-    admin_groups = db.get_all_admin_groups()
+    await delete_expired_users(context, users_to_delete)
+
+
+@timed("job")
+async def retry_failed_deletions(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Фоновая задача: повторяет удаления, которые не удались при предыдущих проверках
+    """
+    if emby_api is None or emby_api.breaker.is_open():
+        return
     
-    for username, emby_user_id, first_login_at in users_to_delete:
-        if emby_api.delete_user(emby_user_id):
-            db.mark_user_as_deleted(emby_user_id)
-            
-            first_login_date = datetime.fromisoformat(first_login_at) if isinstance(first_login_at, str) else first_login_at
-            notification = (
-                f"🗑 Пользователь удален\n\n"
-                f"Имя: {username}\n"
-                f"Первый вход: {first_login_date.strftime('%d.%m.%Y %H:%M')}\n"
-                f"Причина: Прошло 14 дней с первого входа"
-            )
-            
-            for admin_id in admins:
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=notification
-                    )
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки уведомления админу {admin_id}: {e}")
-            
-            for group_id in admin_groups:
-                try:
-                    await context.bot.send_message(
-                        chat_id=group_id,
-                        text=notification
-                    )
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки уведомления в группу {group_id}: {e}")
-            
-            logger.info(f"✅ Пользователь {username} удален и уведомления отправлены")
+    users = await db.get_due_deletion_retries()
+    if not users:
+        return
+    
+    logger.info(f"🔁 Повтор удаления для {len(users)} пользователей")
+    await delete_expired_users(context, users)
+
+
+async def reconcile_with_emby() -> Optional[dict]:
+    """
+    Сверяет БД с текущим списком пользователей 'user*' в Emby
+    
+    Пользователь помечается удаленным, только если его нет в снимке, он был
+    в БД до начала снимка и сервер подтвердил отсутствие ответом 404:
+    постраничный снимок может пропустить пользователей, а импорт - добавить
+    новых, пока снимок собирается.
+    
+    Returns:
+        Списки имен added, restored, deleted, conflicts или None, если список получить не удалось
+    """
+    snapshot_started = int(time.time())
+    emby_users = await emby_api.get_user_name_map()
+    if emby_users is None:
+        return None
+    if not emby_users and await db.get_emby_user_ids('active'):
+        # Пустой ответ при активных пользователях в БД скорее означает ошибку
+        # настройки сервера, чем удаление всех - ничего не помечаем удаленным
+        logger.warning("⚠️ Emby вернул пустой список пользователей, сверка пропущена")
+        return None
+    
+    result = await db.reconcile_users(emby_users, snapshot_started)
+    missing = result.pop('missing')
+    
+    semaphore = asyncio.Semaphore(RECONCILE_CHECK_CONCURRENCY)
+    
+    async def exists(emby_id: str) -> Optional[bool]:
+        async with semaphore:
+            return await emby_api.user_exists(emby_id)
+    
+    found = await asyncio.gather(*(exists(emby_id) for _, emby_id in missing))
+    gone = [(username, emby_id) for (username, emby_id), ok in zip(missing, found) if ok is False]
+    marked = await db.mark_users_missing(emby_id for _, emby_id in gone) if gone else []
+    result['deleted'] = [username for (username, _), ok in zip(gone, marked) if ok]
+    return result
+
+
+def format_reconcile_report(result: dict) -> str:
+    """Текст отчета о сверке с Emby"""
+    text = "🔄 Сверка с Emby\n\n"
+    text += f"➕ Добавлено в БД (созданы в обход бота): {len(result['added'])}\n"
+    if result['added']:
+        text += "   ⏳ Будут удалены через 14 дней после сверки\n"
+    text += f"🗑 Помечено удаленными (удалены из Emby вручную): {len(result['deleted'])}\n"
+    if result['restored']:
+        text += f"♻️ Восстановлено (снова найдены в Emby): {len(result['restored'])}\n"
+    if result['conflicts']:
+        text += f"⚠️ Конфликты имен: {len(result['conflicts'])}\n"
+    # Добавленные аккаунты попадут под автоудаление, поэтому их список показывается шире
+    sections = (
+        ("Добавлены", 'added', 100),
+        ("Удалены", 'deleted', 10),
+        ("Восстановлены", 'restored', 10),
+        ("Конфликты", 'conflicts', 10),
+    )
+    for title, key, limit in sections:
+        names = result[key]
+        if names:
+            text += f"\n{title}: " + ", ".join(names[:limit])
+            if len(names) > limit:
+                text += f" и еще {len(names) - limit}"
+    return text
+
+
+@timed("job")
+async def reconcile_users(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Фоновая задача: исправляет расхождения между БД и Emby
+    и сообщает о них администраторам
+    """
+    if emby_api is None or emby_api.breaker.is_open():
+        return
+    
+    result = await reconcile_with_emby()
+    if not result or not any(result.values()):
+        return
+    
+    dispatcher = NotificationDispatcher(context.bot)
+    recipients = await db.get_all_admins() + await db.get_all_admin_groups()
+    dispatcher.add_many(recipients, format_reconcile_report(result))
+    await dispatcher.flush()
 
 
+@timed("handler")
+@require_admin
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запускает сверку БД с Emby вручную"""
+    status_message = await update.message.reply_text("🔄 Сверяю пользователей с Emby...")
+    result = await reconcile_with_emby()
+    if result is None:
+        await status_message.edit_text("❌ Не удалось получить список пользователей Emby")
+        return
+    await status_message.edit_text(format_reconcile_report(result))
+
+
+async def sweep_first_logins() -> Optional[Tuple[int, int]]:
+    """
+    Обновляет первые входы всех ожидающих пользователей по одному снимку
+    списка пользователей Emby вместо отдельного запроса на каждого
+    
+    Returns:
+        Кортеж (проверено пользователей, обновлено записей) или None, если снимок получить не удалось
+    """
+    pending = await db.get_pending_login_users()
+    if not pending:
+        return 0, 0
+    
+    activity = await emby_api.get_last_activity_map()
+    if activity is None:
+        return None
+    logins = [(emby_id, activity[emby_id]) for _, emby_id in pending if emby_id in activity]
+    
+    updated = sum(await db.update_first_logins(logins)) if logins else 0
+    
+    return len(pending), updated
+
+
+@timed("job")
 async def check_user_logins(context: ContextTypes.DEFAULT_TYPE):
     """
-    Фоновая задача: проверяет первые входы пользователей в Emby
+    Фоновая задача: проверяет первые входы пользователей, у которых подошло время проверки
+    
+    Время следующей проверки хранится в БД и растет экспоненциально,
+    поэтому новые аккаунты проверяются часто, а давно не входившие - редко.
+    Если проверять нужно многих, берется один снимок списка пользователей Emby,
+    иначе пользователи запрашиваются по одному.
     """
     global emby_api
     
@@ -437,28 +879,104 @@ async def check_user_logins(context: ContextTypes.DEFAULT_TYPE):
         logger.error("❌ Emby API не инициализирован")
         return
     
-    logger.info("🔍 Проверка первых входов пользователей...")
+    # Во время недоступности Emby проверки не переносятся: иначе все пользователи
+    # получили бы увеличенный интервал, хотя их просто не удалось проверить
+    if emby_api.breaker.is_open():
+        return
     
-    users = db.get_all_users()
-    updated = 0
+    due = await db.get_due_login_checks(limit=LOGIN_CHECK_BATCH)
+    if not due:
+        return
     
-    for username, emby_id, first_login, is_deleted in users:
-        if is_deleted or first_login:
-            continue
+    logger.info(f"🔍 Проверка первых входов {len(due)} пользователей...")
+    
+    # Пользователи, которых не удалось проверить из-за ошибки Emby, в результаты
+    # не попадают: их проверка не переносится и повторится при следующем запуске
+    if len(due) >= LOGIN_SNAPSHOT_THRESHOLD:
+        activity = await emby_api.get_last_activity_map()
+        if activity is None:
+            return
+        checked = {emby_id: activity.get(emby_id) for _, emby_id in due}
+    else:
+        semaphore = asyncio.Semaphore(LOGIN_CHECK_CONCURRENCY)
         
-        login_time = emby_api.check_user_first_login(emby_id)
-        if login_time:
-            db.update_first_login(emby_id, login_time)
-            updated += 1
-            logger.info(f"✅ Обновлен первый вход для {username}")
+        async def check(emby_id: str):
+            async with semaphore:
+                try:
+                    return emby_id, True, await emby_api.check_user_first_login(emby_id)
+                except httpx.HTTPError:
+                    return emby_id, False, None
+        
+        checked = {
+            emby_id: login_time
+            for emby_id, ok, login_time in await asyncio.gather(*(check(emby_id) for _, emby_id in due))
+            if ok
+        }
+    
+    logins = [(emby_id, login_time) for emby_id, login_time in checked.items() if login_time]
+    waiting = [emby_id for emby_id, login_time in checked.items() if not login_time]
+    
+    updated = sum(await db.update_first_logins(logins)) if logins else 0
+    if waiting:
+        await db.reschedule_login_checks(waiting)
     
     if updated > 0:
-        logger.info(f"✅ Обновлено {updated} записей о первых входах")
+        logger.info(f"✅ Обновлено {updated} из {len(due)} записей о первых входах")
+
+
+async def write_metrics_file(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сохраняет метрики в файл METRICS_FILE"""
+    try:
+        metrics_registry.write_file(METRICS_FILE)
+    except OSError as e:
+        logger.error(f"❌ Ошибка записи файла метрик {METRICS_FILE}: {e}")
+
+
+async def record_first_login(emby_user_id: str, login_time: datetime) -> bool:
+    """
+    Записывает первый вход, о котором сообщил WebSocket Emby
+    
+    Returns:
+        True если первый вход пользователя теперь есть в БД (записан сейчас или раньше),
+        False если пользователя еще нет в БД (например, импорт не успел его записать)
+    """
+    if any(await db.update_first_logins([(emby_user_id, login_time)])):
+        logger.info(f"⚡ Первый вход пользователя {emby_user_id} получен через WebSocket: {login_time}")
+        return True
+    return await db.has_first_login(emby_user_id)
+
+
+async def on_startup(application: Application):
+    """Проверяет подключение к Emby и запускает прослушивание событий после запуска цикла событий"""
+    if not await emby_api.test_connection():
+        logger.warning("⚠️ Не удалось подключиться к Emby серверу при запуске. Бот будет работать, но функции Emby недоступны.")
+        logger.warning("⚠️ Проверьте, что Emby сервер доступен из облака Replit, или используйте публичный URL.")
+    else:
+        logger.info("✅ Успешное подключение к Emby серверу!")
+    
+    if emby_events is not None:
+        emby_events.start()
+    
+    await resume_import_jobs(application.bot)
+
+
+async def on_shutdown(application: Application):
+    """Закрывает пул соединений Emby и подключение к БД при остановке бота"""
+    # Незавершенные импорты остаются в БД и продолжатся при следующем запуске
+    for task in list(import_tasks):
+        task.cancel()
+    await asyncio.gather(*import_tasks, return_exceptions=True)
+    
+    if emby_events is not None:
+        await emby_events.stop()
+    if emby_api is not None:
+        await emby_api.close()
+    await db.close()
 
 
 def main():
     """Главная функция запуска бота"""
-    global emby_api
+    global emby_api, emby_events
     
     telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
     emby_server_url = os.getenv('EMBY_SERVER_URL')
@@ -473,36 +991,76 @@ def main():
         logger.error("❌ EMBY_SERVER_URL или EMBY_API_KEY не установлены!")
         return
     
-    emby_api = EmbyAPI(emby_server_url, emby_api_key)
+    emby_client = create_async_client(
+        pool_size=int(os.getenv('EMBY_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        connect_timeout=float(os.getenv('EMBY_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+        read_timeout=float(os.getenv('EMBY_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        keepalive_expiry=float(os.getenv('EMBY_KEEPALIVE_EXPIRY', DEFAULT_KEEPALIVE_EXPIRY))
+    )
+    emby_breaker = CircuitBreaker(
+        failure_threshold=int(os.getenv('EMBY_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)),
+        recovery_timeout=float(os.getenv('EMBY_RECOVERY_TIMEOUT', DEFAULT_RECOVERY_TIMEOUT))
+    )
+    emby_api = AsyncEmbyAPI(
+        emby_server_url,
+        emby_api_key,
+        client=emby_client,
+        breaker=emby_breaker,
+        max_retries=int(os.getenv('EMBY_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+    )
     
-    if not emby_api.test_connection():
-        logger.warning("⚠️ Не удалось подключиться к Emby серверу при запуске. Бот будет работать, но функции Emby недоступны.")
-        logger.warning("⚠️ Проверьте, что Emby сервер доступен из облака Replit, или используйте публичный URL.")
-    else:
-        logger.info("✅ Успешное подключение к Emby серверу!")
+    if os.getenv('EMBY_WEBSOCKET', '0') == '1':
+        if EmbyEventListener.is_available():
+            emby_events = EmbyEventListener(
+                build_websocket_url(emby_server_url, emby_api_key),
+                on_login=record_first_login
+            )
+            logger.info("✅ Первые входы будут приходить через WebSocket, периодическая проверка остается резервной")
+        else:
+            logger.warning("⚠️ EMBY_WEBSOCKET=1, но пакет websockets не установлен (pip install websockets)")
     
     if first_admin_id:
         try:
-            db.add_admin(int(first_admin_id))
+            db.db.add_admin(int(first_admin_id))
             logger.info(f"✅ Первый администратор {first_admin_id} добавлен")
         except ValueError:
             logger.error("❌ Неверный формат FIRST_ADMIN_ID")
     
-    application = Application.builder().token(telegram_token).build()
+    application = (
+        Application.builder()
+        .token(telegram_token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("add_admin", add_admin))
     application.add_handler(CommandHandler("remove_admin", remove_admin))
     application.add_handler(CommandHandler("add_admin_group", add_admin_group))
+    application.add_handler(CommandHandler("user_stats", user_stats))
+    application.add_handler(CommandHandler("metrics", show_metrics))
+    application.add_handler(CommandHandler("bulk_policy", bulk_policy))
+    application.add_handler(CommandHandler("reconcile", reconcile))
     
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     
     application.add_handler(CallbackQueryHandler(button_callback))
     
-    application.job_queue.run_repeating(check_user_logins, interval=3600, first=10)
+    application.job_queue.run_repeating(check_user_logins, interval=LOGIN_POLL_INTERVAL, first=10)
     
     application.job_queue.run_repeating(check_and_delete_users, interval=21600, first=60)
     
+    application.job_queue.run_repeating(retry_failed_deletions, interval=300, first=120)
+    
+    application.job_queue.run_repeating(reconcile_users, interval=RECONCILE_INTERVAL, first=300)
+    
+    if METRICS_FILE:
+        application.job_queue.run_repeating(write_metrics_file, interval=METRICS_FILE_INTERVAL, first=METRICS_FILE_INTERVAL)
+    
+    if METRICS_PORT:
+        metrics_registry.start_http_server(METRICS_PORT, METRICS_HOST)
+    
     logger.info("🤖 Бот запущен!")
     
     application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -3,61 +3,413 @@
 Хранит информацию о пользователях Emby и времени их первого входа
 """
 
+import asyncio
+import calendar
+import functools
+import os
 import sqlite3
-from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 import logging
 
+from metrics import mark_error, timed
+
 logger = logging.getLogger(__name__)
 
 
+STATEMENT_CACHE_SIZE = 256
+
+# Потоки-читатели AsyncDatabase: у каждого свое подключение только для чтения
+DEFAULT_DB_READERS = 2
+
+# Адаптивная проверка первых входов: интервал удваивается после каждой
+# безуспешной проверки, начиная с LOGIN_CHECK_BASE_INTERVAL, в секундах
+LOGIN_CHECK_BASE_INTERVAL = 300
+LOGIN_CHECK_MAX_INTERVAL = 24 * 3600
+
+# Фильтры постраничного списка пользователей
+USER_STATUS_FILTERS = {
+    'all': "1 = 1",
+    'active': "is_deleted = 0",
+    'pending': "first_login_at IS NULL AND is_deleted = 0",
+    'logged_in': "first_login_at IS NOT NULL AND is_deleted = 0",
+    'deleted': "is_deleted = 1",
+}
+
+# Задержки очереди повторов удаления, в секундах
+DELETION_RETRY_BASE_DELAY = 120
+DELETION_RETRY_MAX_DELAY = 6 * 3600
+
+# Текущее время как метка Unix на стороне SQLite (для DEFAULT и UPDATE)
+EPOCH_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+
+def to_epoch(value: datetime) -> int:
+    """
+    Переводит datetime в метку времени Unix для записи в БД
+    
+    Datetime без часового пояса считается временем UTC (так возвращает даты parse_emby_date).
+    """
+    return calendar.timegm(value.utctimetuple())
+
+
+def from_epoch(value: int) -> datetime:
+    """Переводит метку времени Unix из БД в локальное время для отображения"""
+    return datetime.fromtimestamp(value)
+
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, созданную старой версией бота"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"✅ В таблицу {table} добавлена колонка {column}")
+
+
+def _text_to_epoch(column: str, local: bool = False) -> str:
+    """
+    SQL выражение, переводящее текстовую дату колонки в метку времени Unix
+    
+    Args:
+        column: Имя колонки
+        local: Дата записана в локальном времени (datetime.now()), а не в UTC (CURRENT_TIMESTAMP)
+    """
+    modifier = ", 'utc'" if local else ""
+    return (
+        f"CASE WHEN typeof({column}) = 'text' "
+        f"THEN CAST(strftime('%s', {column}{modifier}) AS INTEGER) ELSE {column} END"
+    )
+
+
+def _rebuild_table(conn: sqlite3.Connection, table: str, schema: str, select: str):
+    """
+    Пересоздает таблицу по новой схеме с переносом строк
+    
+    SQLite не умеет менять тип и DEFAULT существующей колонки, поэтому
+    строки копируются в новую таблицу, а старая удаляется вместе с индексами.
+    
+    Args:
+        table: Имя таблицы
+        schema: Определения колонок новой таблицы
+        select: Список выражений SELECT по старой таблице в порядке колонок новой
+    """
+    conn.execute(f"CREATE TABLE {table}_new ({schema})")
+    conn.execute(f"INSERT INTO {table}_new SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def _migration_baseline(conn: sqlite3.Connection):
+    """исходная схема"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS emby_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            emby_user_id TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            first_login_at TIMESTAMP,
+            is_deleted BOOLEAN DEFAULT 0,
+            deleted_at TIMESTAMP,
+            login_check_attempts INTEGER DEFAULT 0,
+            next_login_check_at TIMESTAMP
+        )
+    ''')
+    # Колонки, которых нет в БД, созданных до появления версий схемы
+    _add_column_if_missing(conn, "emby_users", "deleted_at", "TIMESTAMP")
+    _add_column_if_missing(conn, "emby_users", "login_check_attempts", "INTEGER DEFAULT 0")
+    _add_column_if_missing(conn, "emby_users", "next_login_check_at", "TIMESTAMP")
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            telegram_username TEXT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS admin_groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_group_id INTEGER UNIQUE NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deletion_retries (
+            emby_user_id TEXT PRIMARY KEY,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    
+    # Результат каждой обработанной строки импорта: по нему задание
+    # продолжается после перезапуска без повторной отправки строк в Emby
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_rows (
+            job_id INTEGER NOT NULL,
+            row INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            status TEXT NOT NULL,
+            emby_user_id TEXT,
+            error TEXT,
+            PRIMARY KEY (job_id, row)
+        )
+    ''')
+
+
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    """даты хранятся как метки времени Unix (INTEGER, UTC)"""
+    # CURRENT_TIMESTAMP и даты Emby записаны в UTC, а расписания проверок
+    # и повторов - от datetime.now(), то есть в локальном времени
+    _rebuild_table(conn, "emby_users", f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        emby_user_id TEXT UNIQUE NOT NULL,
+        created_at INTEGER NOT NULL DEFAULT ({EPOCH_NOW_SQL}),
+        first_login_at INTEGER,
+        is_deleted BOOLEAN DEFAULT 0,
+        deleted_at INTEGER,
+        login_check_attempts INTEGER DEFAULT 0,
+        next_login_check_at INTEGER
+    ''', f'''
+        id, username, emby_user_id,
+        COALESCE({_text_to_epoch("created_at")}, {EPOCH_NOW_SQL}),
+        {_text_to_epoch("first_login_at")},
+        is_deleted,
+        {_text_to_epoch("deleted_at")},
+        login_check_attempts,
+        {_text_to_epoch("next_login_check_at", local=True)}
+    ''')
+    
+    _rebuild_table(conn, "admins", f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        telegram_username TEXT,
+        added_at INTEGER DEFAULT ({EPOCH_NOW_SQL})
+    ''', f'id, telegram_id, telegram_username, {_text_to_epoch("added_at")}')
+    
+    _rebuild_table(conn, "admin_groups", f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_group_id INTEGER UNIQUE NOT NULL,
+        added_at INTEGER DEFAULT ({EPOCH_NOW_SQL})
+    ''', f'id, telegram_group_id, {_text_to_epoch("added_at")}')
+    
+    _rebuild_table(conn, "deletion_retries", '''
+        emby_user_id TEXT PRIMARY KEY,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL,
+        last_error TEXT
+    ''', f'emby_user_id, attempts, {_text_to_epoch("next_attempt_at", local=True)}, last_error')
+    
+    _rebuild_table(conn, "import_jobs", f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT NOT NULL,
+        file_path TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER DEFAULT ({EPOCH_NOW_SQL}),
+        finished_at INTEGER
+    ''', f'''
+        id, file_name, file_path, chat_id, status,
+        {_text_to_epoch("created_at")}, {_text_to_epoch("finished_at")}
+    ''')
+    
+    # Индексы удалены вместе со старыми таблицами.
+    # Частичные индексы покрывают только строки, нужные фоновым задачам:
+    # ожидающих первого входа и кандидатов на удаление
+    conn.execute('''
+        CREATE INDEX idx_emby_users_pending_login
+        ON emby_users (username, emby_user_id)
+        WHERE first_login_at IS NULL AND is_deleted = 0
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_emby_users_login_schedule
+        ON emby_users (next_login_check_at)
+        WHERE first_login_at IS NULL AND is_deleted = 0
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_emby_users_expiring
+        ON emby_users (first_login_at, username, emby_user_id)
+        WHERE first_login_at IS NOT NULL AND is_deleted = 0 AND username LIKE 'user%'
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_emby_users_created
+        ON emby_users (created_at, id)
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_emby_users_first_login
+        ON emby_users (first_login_at)
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_emby_users_deleted_at
+        ON emby_users (deleted_at)
+        WHERE deleted_at IS NOT NULL
+    ''')
+    
+    conn.execute('''
+        CREATE INDEX idx_deletion_retries_next_attempt
+        ON deletion_retries (next_attempt_at)
+    ''')
+
+
+def _migration_missing_in_emby(conn: sqlite3.Connection):
+    """отметка пользователей, удаленных из Emby в обход бота"""
+    conn.execute("ALTER TABLE emby_users ADD COLUMN missing_in_emby INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_partial_first_login_index(conn: sqlite3.Connection):
+    """индекс по first_login_at только для вошедших пользователей"""
+    # Полный индекс перехватывал запросы с first_login_at IS NULL у частичных
+    # индексов ожидающих первого входа и сортировал во временном B-дереве.
+    # Гистограмме статистики нужны только строки с заполненной датой.
+    conn.execute("DROP INDEX IF EXISTS idx_emby_users_first_login")
+    conn.execute('''
+        CREATE INDEX idx_emby_users_first_login
+        ON emby_users (first_login_at)
+        WHERE first_login_at IS NOT NULL
+    ''')
+
+
+# Миграции схемы по порядку: миграция с индексом i переводит БД с версии i
+# на версию i + 1 (PRAGMA user_version). Новые миграции добавляются в конец,
+# уже выпущенные не меняются.
+MIGRATIONS: Tuple[Callable[[sqlite3.Connection], None], ...] = (
+    _migration_baseline,
+    _migration_epoch_timestamps,
+    _migration_missing_in_emby,
+    _migration_partial_first_login_index,
+)
+
+
 class Database:
     def __init__(self, db_path: str = "emby_bot.db"):
         """Инициализация подключения к базе данных"""
         self.db_path = db_path
+        self.conn = self._connect()
+        self._local = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._reader_lock = threading.Lock()
+        self._admin_ids: Optional[FrozenSet[int]] = None
+        self._admin_group_ids: Optional[FrozenSet[int]] = None
         self.init_db()
     
-    def get_connection(self):
-        """Создает подключение к БД"""
-        return sqlite3.connect(self.db_path)
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Открывает постоянное подключение к БД
+        
+        WAL позволяет читать во время записи, synchronous=NORMAL делает fsync
+        только при чекпоинтах, а кэш подготовленных выражений избавляет
+        от повторного разбора одних и тех же запросов.
+        """
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def _open_reader(self):
+        """
+        Открывает подключение только для чтения для текущего потока
+        
+        Используется как initializer пула читателей AsyncDatabase: после него
+        get_connection в этом потоке возвращает подключение читателя.
+        """
+        conn = sqlite3.connect(
+            f"{Path(self.db_path).resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self._local.conn = conn
+        with self._reader_lock:
+            self._reader_conns.append(conn)
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """Возвращает подключение текущего потока-читателя или постоянное подключение к БД"""
+        return getattr(self._local, 'conn', self.conn)
+    
+    def close(self):
+        """Закрывает подключение к БД"""
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        # Обновляет статистику планировщика, чтобы частичные индексы выбирались вместо полных
+        self.conn.execute("PRAGMA optimize")
+        self.conn.close()
+        logger.info("✅ Подключение к базе данных закрыто")
     
     def init_db(self):
-        """Создает таблицы в базе данных если они не существуют"""
+        """Создает схему БД или обновляет ее до последней версии"""
         conn = self.get_connection()
-        cursor = conn.cursor()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS emby_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                emby_user_id TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                first_login_at TIMESTAMP,
-                is_deleted BOOLEAN DEFAULT 0
-            )
-        ''')
+        for target, migration in enumerate(MIGRATIONS[version:], version + 1):
+            try:
+                conn.execute("BEGIN")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"❌ Ошибка миграции БД до версии {target}, изменения отменены: {e}")
+                raise
+            logger.info(f"🛠 Схема БД обновлена до версии {target}: {migration.__doc__.strip()}")
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                telegram_username TEXT,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        logger.info("✅ База данных инициализирована")
+    
+    def _execute_batch(self, sql: str, rows: Iterable[tuple]) -> List[bool]:
+        """
+        Выполняет один запрос для каждой строки в рамках одной транзакции
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_group_id INTEGER UNIQUE NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        Запрос разбирается один раз (кэш подготовленных выражений), а коммит
+        и fsync выполняются один раз на всю пачку. Строки выполняются по одной,
+        а не через executemany, чтобы вернуть результат для каждой из них.
         
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
+        Returns:
+            Список флагов "строка изменена" в порядке входных данных
+        """
+        conn = self.get_connection()
+        try:
+            with conn:
+                return [conn.execute(sql, row).rowcount > 0 for row in rows]
+        except Exception as e:
+            mark_error()
+            logger.error(f"❌ Ошибка пакетной записи в БД, транзакция отменена: {e}")
+            raise
     
+    @timed("db")
     def add_emby_user(self, username: str, emby_user_id: str) -> bool:
         """Добавляет пользователя Emby в базу данных"""
         try:
@@ -68,13 +420,32 @@ class Database:
                 (username, emby_user_id)
             )
             conn.commit()
-            conn.close()
             logger.info(f"✅ Пользователь {username} добавлен в БД")
             return True
         except sqlite3.IntegrityError:
+            conn.rollback()
             logger.warning(f"⚠️ Пользователь {username} уже существует в БД")
             return False
     
+    @timed("db")
+    def add_emby_users(self, users: Iterable[Tuple[str, str]]) -> List[bool]:
+        """
+        Добавляет пачку пользователей Emby одной транзакцией
+        
+        Args:
+            users: Пары (имя пользователя, ID в Emby)
+        
+        Returns:
+            Для каждой пары True если добавлена, False если уже существовала
+        """
+        results = self._execute_batch(
+            "INSERT OR IGNORE INTO emby_users (username, emby_user_id) VALUES (?, ?)",
+            users
+        )
+        logger.info(f"✅ Добавлено {sum(results)} из {len(results)} пользователей в БД")
+        return results
+    
+    @timed("db")
     def update_first_login(self, emby_user_id: str, first_login_time: datetime) -> bool:
         """Обновляет время первого входа пользователя"""
         try:
@@ -82,24 +453,45 @@ class Database:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE emby_users SET first_login_at = ? WHERE emby_user_id = ? AND first_login_at IS NULL",
-                (first_login_time, emby_user_id)
+                (to_epoch(first_login_time), emby_user_id)
             )
             conn.commit()
             updated = cursor.rowcount > 0
-            conn.close()
             if updated:
                 logger.info(f"✅ Обновлено время первого входа для пользователя {emby_user_id}")
             return updated
         except Exception as e:
+            mark_error()
+            conn.rollback()
             logger.error(f"❌ Ошибка при обновлении времени первого входа: {e}")
             return False
     
-    def get_users_to_delete(self, days: int = 14) -> List[Tuple[str, str, datetime]]:
+    @timed("db")
+    def update_first_logins(self, logins: Iterable[Tuple[str, datetime]]) -> List[bool]:
+        """
+        Записывает время первого входа для пачки пользователей одной транзакцией
+        
+        Args:
+            logins: Пары (ID в Emby, время первого входа)
+        
+        Returns:
+            Для каждой пары True если запись обновлена (вход еще не был записан)
+        """
+        results = self._execute_batch(
+            "UPDATE emby_users SET first_login_at = ? WHERE emby_user_id = ? AND first_login_at IS NULL",
+            ((to_epoch(first_login_time), emby_user_id) for emby_user_id, first_login_time in logins)
+        )
+        if any(results):
+            logger.info(f"✅ Обновлено время первого входа для {sum(results)} пользователей")
+        return results
+    
+    @timed("db")
+    def get_users_to_delete(self, days: int = 14) -> List[Tuple[str, str, int]]:
         """Получает список пользователей для удаления (прошло N дней после первого входа)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cutoff_date = datetime.now() - timedelta(days=days)
+        cutoff = int(time.time()) - days * 86400
         
         cursor.execute('''
             SELECT username, emby_user_id, first_login_at
@@ -108,31 +500,171 @@ class Database:
             AND first_login_at <= ?
             AND is_deleted = 0
             AND username LIKE 'user%'
-        ''', (cutoff_date,))
+        ''', (cutoff,))
         
         users = cursor.fetchall()
-        conn.close()
         
         logger.info(f"📋 Найдено {len(users)} пользователей для удаления")
         return users
     
+    @timed("db")
+    def schedule_deletion_retries(self, failures: Iterable[Tuple[str, str]]) -> int:
+        """
+        Записывает неудачные удаления в очередь повторов с экспоненциальной задержкой
+        
+        Задержка начинается с DELETION_RETRY_BASE_DELAY и удваивается с каждой
+        попыткой, но не превышает DELETION_RETRY_MAX_DELAY.
+        
+        Args:
+            failures: Пары (ID в Emby, текст ошибки)
+        
+        Returns:
+            Количество записей в очереди повторов, затронутых вызовом
+        """
+        failures = list(failures)
+        if not failures:
+            return 0
+        
+        conn = self.get_connection()
+        now = int(time.time())
+        try:
+            with conn:
+                for emby_user_id, error in failures:
+                    row = conn.execute(
+                        "SELECT attempts FROM deletion_retries WHERE emby_user_id = ?",
+                        (emby_user_id,)
+                    ).fetchone()
+                    attempts = (row[0] if row else 0) + 1
+                    delay = min(DELETION_RETRY_BASE_DELAY * 2 ** (attempts - 1), DELETION_RETRY_MAX_DELAY)
+                    conn.execute('''
+                        INSERT INTO deletion_retries (emby_user_id, attempts, next_attempt_at, last_error)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (emby_user_id) DO UPDATE SET
+                            attempts = excluded.attempts,
+                            next_attempt_at = excluded.next_attempt_at,
+                            last_error = excluded.last_error
+                    ''', (emby_user_id, attempts, now + delay, error))
+        except Exception as e:
+            mark_error()
+            logger.error(f"❌ Ошибка при записи очереди повторов удаления: {e}")
+            return 0
+        
+        logger.info(f"🔁 {len(failures)} неудачных удалений поставлены в очередь повторов")
+        return len(failures)
+    
+    @timed("db")
+    def get_due_deletion_retries(self) -> List[Tuple[str, str, int]]:
+        """Получает пользователей из очереди повторов удаления, у которых подошло время попытки"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.username, u.emby_user_id, u.first_login_at
+            FROM deletion_retries r
+            JOIN emby_users u ON u.emby_user_id = r.emby_user_id
+            WHERE r.next_attempt_at <= ?
+            AND u.is_deleted = 0
+            ORDER BY r.next_attempt_at
+        ''', (int(time.time()),))
+        return cursor.fetchall()
+    
+    @timed("db")
+    def clear_deletion_retries(self, emby_user_ids: Iterable[str]) -> List[bool]:
+        """Убирает пользователей из очереди повторов удаления"""
+        return self._execute_batch(
+            "DELETE FROM deletion_retries WHERE emby_user_id = ?",
+            ((emby_user_id,) for emby_user_id in emby_user_ids)
+        )
+    
+    @timed("db")
+    def get_pending_login_users(self) -> List[Tuple[str, str]]:
+        """Получает активных пользователей, которые еще ни разу не входили"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT username, emby_user_id
+            FROM emby_users
+            WHERE first_login_at IS NULL
+            AND is_deleted = 0
+        ''')
+        users = cursor.fetchall()
+        return users
+    
+    @timed("db")
+    def get_due_login_checks(self, limit: int = 500) -> List[Tuple[str, str]]:
+        """
+        Получает ожидающих первого входа пользователей, которых пора проверить
+        
+        Новые пользователи (еще ни разу не проверенные) идут первыми,
+        затем - в порядке наступления времени проверки.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT username, emby_user_id
+            FROM emby_users
+            WHERE first_login_at IS NULL
+            AND is_deleted = 0
+            AND (next_login_check_at IS NULL OR next_login_check_at <= ?)
+            ORDER BY next_login_check_at
+            LIMIT ?
+        ''', (int(time.time()), limit))
+        return cursor.fetchall()
+    
+    @timed("db")
+    def reschedule_login_checks(self, emby_user_ids: Iterable[str]) -> List[bool]:
+        """
+        Откладывает следующую проверку входа для пользователей, которые еще не входили
+        
+        Интервал равен LOGIN_CHECK_BASE_INTERVAL * 2^(число проверок), но не больше
+        LOGIN_CHECK_MAX_INTERVAL: свежие аккаунты проверяются часто, давно
+        созданные и так и не вошедшие - все реже.
+        """
+        now = int(time.time())
+        return self._execute_batch('''
+            UPDATE emby_users
+            SET next_login_check_at = ? + MIN(?, ? * (1 << MIN(COALESCE(login_check_attempts, 0), 30))),
+                login_check_attempts = COALESCE(login_check_attempts, 0) + 1
+            WHERE emby_user_id = ? AND first_login_at IS NULL
+        ''', ((now, LOGIN_CHECK_MAX_INTERVAL, LOGIN_CHECK_BASE_INTERVAL, emby_user_id) for emby_user_id in emby_user_ids))
+    
+    @timed("db")
     def mark_user_as_deleted(self, emby_user_id: str) -> bool:
         """Отмечает пользователя как удаленного"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute(
-                "UPDATE emby_users SET is_deleted = 1 WHERE emby_user_id = ?",
+                f"UPDATE emby_users SET is_deleted = 1, deleted_at = {EPOCH_NOW_SQL} WHERE emby_user_id = ?",
                 (emby_user_id,)
             )
             conn.commit()
-            conn.close()
             logger.info(f"✅ Пользователь {emby_user_id} отмечен как удаленный")
             return True
         except Exception as e:
+            mark_error()
+            conn.rollback()
             logger.error(f"❌ Ошибка при отметке пользователя как удаленного: {e}")
             return False
     
+    @timed("db")
+    def mark_users_deleted(self, emby_user_ids: Iterable[str]) -> List[bool]:
+        """
+        Отмечает пачку пользователей как удаленных одной транзакцией
+        
+        Args:
+            emby_user_ids: ID пользователей в Emby
+        
+        Returns:
+            Для каждого ID True если запись найдена и отмечена
+        """
+        results = self._execute_batch(
+            f"UPDATE emby_users SET is_deleted = 1, deleted_at = {EPOCH_NOW_SQL} WHERE emby_user_id = ?",
+            ((emby_user_id,) for emby_user_id in emby_user_ids)
+        )
+        logger.info(f"✅ {sum(results)} пользователей отмечены как удаленные")
+        return results
+    
+    @timed("db")
     def add_admin(self, telegram_id: int, telegram_username: Optional[str] = None) -> bool:
         """Добавляет администратора"""
         try:
@@ -143,13 +675,15 @@ class Database:
                 (telegram_id, telegram_username)
             )
             conn.commit()
-            conn.close()
+            self._admin_ids = None
             logger.info(f"✅ Администратор {telegram_id} добавлен")
             return True
         except sqlite3.IntegrityError:
+            conn.rollback()
             logger.warning(f"⚠️ Администратор {telegram_id} уже существует")
             return False
     
+    @timed("db")
     def remove_admin(self, telegram_id: int) -> bool:
         """Удаляет администратора"""
         try:
@@ -158,32 +692,41 @@ class Database:
             cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
             deleted = cursor.rowcount > 0
-            conn.close()
             if deleted:
+                self._admin_ids = None
                 logger.info(f"✅ Администратор {telegram_id} удален")
             return deleted
         except Exception as e:
+            mark_error()
+            conn.rollback()
             logger.error(f"❌ Ошибка при удалении администратора: {e}")
             return False
     
+    def _get_admin_ids(self) -> FrozenSet[int]:
+        """
+        Возвращает кэш ID администраторов
+        
+        Загружается из БД при первом обращении и сбрасывается при add_admin/remove_admin,
+        поэтому проверка прав на каждом апдейте не обращается к SQLite.
+        """
+        if self._admin_ids is None:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT telegram_id FROM admins")
+            self._admin_ids = frozenset(row[0] for row in cursor.fetchall())
+        return self._admin_ids
+    
+    @timed("db")
     def is_admin(self, telegram_id: int) -> bool:
         """Проверяет, является ли пользователь администратором"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM admins WHERE telegram_id = ?", (telegram_id,))
-        is_admin = cursor.fetchone() is not None
-        conn.close()
-        return is_admin
+        return telegram_id in self._get_admin_ids()
     
+    @timed("db")
     def get_all_admins(self) -> List[int]:
         """Получает список всех администраторов"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT telegram_id FROM admins")
-        admins = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return admins
+        return list(self._get_admin_ids())
     
+    @timed("db")
     def add_admin_group(self, telegram_group_id: int) -> bool:
         """Добавляет группу администраторов"""
         try:
@@ -194,13 +737,15 @@ class Database:
                 (telegram_group_id,)
             )
             conn.commit()
-            conn.close()
+            self._admin_group_ids = None
             logger.info(f"✅ Группа администраторов {telegram_group_id} добавлена")
             return True
         except sqlite3.IntegrityError:
+            conn.rollback()
             logger.warning(f"⚠️ Группа {telegram_group_id} уже существует")
             return False
     
+    @timed("db")
     def remove_admin_group(self, telegram_group_id: int) -> bool:
         """Удаляет группу администраторов"""
         try:
@@ -209,24 +754,59 @@ class Database:
             cursor.execute("DELETE FROM admin_groups WHERE telegram_group_id = ?", (telegram_group_id,))
             conn.commit()
             deleted = cursor.rowcount > 0
-            conn.close()
             if deleted:
+                self._admin_group_ids = None
                 logger.info(f"✅ Группа администраторов {telegram_group_id} удалена")
             return deleted
         except Exception as e:
+            mark_error()
+            conn.rollback()
             logger.error(f"❌ Ошибка при удалении группы: {e}")
             return False
     
+    def _get_admin_group_ids(self) -> FrozenSet[int]:
+        """Возвращает кэш ID групп администраторов (сбрасывается при add_admin_group/remove_admin_group)"""
+        if self._admin_group_ids is None:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT telegram_group_id FROM admin_groups")
+            self._admin_group_ids = frozenset(row[0] for row in cursor.fetchall())
+        return self._admin_group_ids
+    
+    @timed("db")
+    def is_admin_group(self, telegram_group_id: int) -> bool:
+        """Проверяет, является ли группа группой администраторов"""
+        return telegram_group_id in self._get_admin_group_ids()
+    
+    @timed("db")
     def get_all_admin_groups(self) -> List[int]:
         """Получает список всех групп администраторов"""
+        return list(self._get_admin_group_ids())
+    
+    @timed("db")
+    def has_first_login(self, emby_user_id: str) -> bool:
+        """Записан ли первый вход пользователя"""
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT 1 FROM emby_users WHERE emby_user_id = ? AND first_login_at IS NOT NULL",
+            (emby_user_id,)
+        ).fetchone()
+        return row is not None
+    
+    @timed("db")
+    def get_user_by_username(self, username: str) -> Optional[Tuple[str, str, Optional[int], bool]]:
+        """Получает пользователя по имени"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT telegram_group_id FROM admin_groups")
-        groups = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return groups
+        cursor.execute('''
+            SELECT username, emby_user_id, first_login_at, is_deleted
+            FROM emby_users
+            WHERE username = ?
+        ''', (username,))
+        return cursor.fetchone()
     
-    def get_all_users(self) -> List[Tuple[str, str, Optional[datetime], bool]]:
+    @timed("db")
+    def get_all_users(self) -> List[Tuple[str, str, Optional[int], bool]]:
         """Получает список всех пользователей"""
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -236,5 +816,394 @@ class Database:
             ORDER BY created_at DESC
         ''')
         users = cursor.fetchall()
-        conn.close()
         return users
+    
+    @timed("db")
+    def reconcile_users(self, emby_users: Dict[str, str], snapshot_started: int) -> Dict[str, List]:
+        """
+        Сверяет пользователей 'user*' в БД со снимком сервера Emby
+        
+        Снимок и строки БД сопоставляются по emby_user_id через словари
+        (hash join) за один проход, изменения применяются одной транзакцией:
+        пользователи, созданные в Emby в обход бота, добавляются в БД с первым
+        входом в момент сверки (полный срок до удаления), а ранее
+        помеченные сверкой отсутствующими, но снова найденные - восстанавливаются.
+        
+        Отсутствующие в снимке пользователи только возвращаются в missing:
+        снимок собирается постранично и мог их пропустить, поэтому пометить их
+        удаленными можно только после проверки (mark_users_missing). Строки,
+        добавленные после начала снимка (например, импортом), не проверяются.
+        
+        Args:
+            emby_users: Снимок {ID в Emby: имя пользователя}
+            snapshot_started: Метка времени Unix начала сбора снимка
+        
+        Returns:
+            Словарь: added, restored, conflicts - списки имен (добавлены в БД,
+            восстановлены, есть в Emby, но имя в БД занято другим ID);
+            missing - пары (имя, ID в Emby) активных пользователей, которых нет в снимке
+        """
+        conn = self.get_connection()
+        try:
+            with conn:
+                known = {
+                    emby_user_id: (username, is_deleted, missing_in_emby, created_at)
+                    for emby_user_id, username, is_deleted, missing_in_emby, created_at in conn.execute('''
+                        SELECT emby_user_id, username, is_deleted, missing_in_emby, created_at
+                        FROM emby_users
+                        WHERE username LIKE 'user%'
+                    ''')
+                }
+                known_names = {row[0] for row in known.values()}
+                
+                added = []
+                restored = []
+                conflicts = []
+                for emby_user_id, username in emby_users.items():
+                    row = known.get(emby_user_id)
+                    if row is not None:
+                        if row[1] and row[2]:
+                            restored.append((row[0], emby_user_id))
+                    elif username in known_names:
+                        conflicts.append(username)
+                    else:
+                        added.append((username, emby_user_id))
+                
+                missing = [
+                    (username, emby_user_id)
+                    for emby_user_id, (username, is_deleted, _, created_at) in known.items()
+                    if not is_deleted and created_at < snapshot_started and emby_user_id not in emby_users
+                ]
+                
+                # Прошлая активность созданных в обход бота пользователей не считается
+                # первым входом: срок до удаления отсчитывается от момента сверки
+                conn.executemany(
+                    "INSERT OR IGNORE INTO emby_users (username, emby_user_id, first_login_at) "
+                    f"VALUES (?, ?, {EPOCH_NOW_SQL})",
+                    added
+                )
+                conn.executemany('''
+                    UPDATE emby_users SET is_deleted = 0, deleted_at = NULL, missing_in_emby = 0
+                    WHERE emby_user_id = ? AND missing_in_emby = 1
+                ''', ((emby_user_id,) for _, emby_user_id in restored))
+        except Exception as e:
+            mark_error()
+            logger.error(f"❌ Ошибка сверки пользователей с Emby, транзакция отменена: {e}")
+            raise
+        
+        logger.info(
+            f"🔄 Сверка с Emby: добавлено {len(added)}, восстановлено {len(restored)}, "
+            f"нет в снимке {len(missing)}, конфликтов имен {len(conflicts)}"
+        )
+        return {
+            'added': [username for username, _ in added],
+            'restored': [username for username, _ in restored],
+            'conflicts': conflicts,
+            'missing': missing,
+        }
+    
+    @timed("db")
+    def mark_users_missing(self, emby_user_ids: Iterable[str]) -> List[bool]:
+        """
+        Помечает удаленными пользователей, которых больше нет в Emby
+        
+        В отличие от mark_users_deleted, отметка снимается сверкой,
+        если пользователь снова появится в Emby.
+        
+        Returns:
+            Для каждого ID True если активная запись найдена и помечена
+        """
+        emby_user_ids = list(emby_user_ids)
+        results = self._execute_batch(
+            f"UPDATE emby_users SET is_deleted = 1, deleted_at = {EPOCH_NOW_SQL}, missing_in_emby = 1 "
+            "WHERE emby_user_id = ? AND is_deleted = 0",
+            ((emby_user_id,) for emby_user_id in emby_user_ids)
+        )
+        self.clear_deletion_retries(emby_user_id for emby_user_id, marked in zip(emby_user_ids, results) if marked)
+        logger.info(f"🗑 {sum(results)} пользователей, удаленных из Emby вручную, помечены удаленными")
+        return results
+    
+    @timed("db")
+    def get_emby_user_ids(self, status: str = 'active') -> Set[str]:
+        """
+        Получает ID в Emby пользователей 'user*' с заданным статусом
+        
+        Args:
+            status: Фильтр из USER_STATUS_FILTERS
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT emby_user_id
+            FROM emby_users
+            WHERE {USER_STATUS_FILTERS[status]}
+            AND username LIKE 'user%'
+        ''')
+        return {row[0] for row in cursor.fetchall()}
+    
+    @timed("db")
+    def get_users_page(
+        self,
+        status: str = 'all',
+        cursor: Optional[Tuple[int, int]] = None,
+        backward: bool = False,
+        limit: int = 20
+    ) -> Tuple[List[Tuple[int, str, str, Optional[int], bool, int]], bool]:
+        """
+        Получает страницу пользователей (новые сначала) с keyset-пагинацией
+        
+        Вместо OFFSET используется курсор (created_at, id) последней показанной строки,
+        поэтому стоимость запроса не зависит от номера страницы.
+        
+        Args:
+            status: Фильтр из USER_STATUS_FILTERS
+            cursor: (created_at, id) крайней строки соседней страницы или None для первой страницы
+            backward: True - страница перед курсором (более новые), False - после него
+            limit: Размер страницы
+        
+        Returns:
+            Кортеж (строки (id, username, emby_user_id, first_login_at, is_deleted, created_at),
+            есть ли еще строки в направлении листания)
+        """
+        where = [USER_STATUS_FILTERS[status]]
+        params: list = []
+        if cursor is not None:
+            where.append("(created_at, id) > (?, ?)" if backward else "(created_at, id) < (?, ?)")
+            params.extend(cursor)
+        order = "ASC" if backward else "DESC"
+        
+        conn = self.get_connection()
+        db_cursor = conn.cursor()
+        db_cursor.execute(f'''
+            SELECT id, username, emby_user_id, first_login_at, is_deleted, created_at
+            FROM emby_users
+            WHERE {" AND ".join(where)}
+            ORDER BY created_at {order}, id {order}
+            LIMIT ?
+        ''', (*params, limit + 1))
+        rows = db_cursor.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+    
+    @timed("db")
+    def get_user_stats(self, days: int = 7) -> Dict[str, Any]:
+        """
+        Считает статистику пользователей на стороне SQLite
+        
+        Итоговые счетчики считаются одним агрегирующим запросом, дневные
+        гистограммы создания, первых входов и удалений за последние days дней -
+        одним запросом с GROUP BY по индексированным датам.
+        
+        Returns:
+            Словарь со счетчиками total, active, logged_in, pending, deleted
+            и гистограммой daily {дата: {'created': n, 'logins': n, 'deleted': n}}
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(is_deleted = 0), 0),
+                COALESCE(SUM(first_login_at IS NOT NULL), 0),
+                COALESCE(SUM(first_login_at IS NULL AND is_deleted = 0), 0),
+                COALESCE(SUM(is_deleted = 1), 0)
+            FROM emby_users
+        ''')
+        total, active, logged_in, pending, deleted = cursor.fetchone()
+        
+        # Начало первого дня гистограммы (полночь UTC)
+        since = (int(time.time()) // 86400 - (days - 1)) * 86400
+        cursor.execute('''
+            SELECT 'created', date(created_at, 'unixepoch') AS day, COUNT(*)
+            FROM emby_users WHERE created_at >= ? GROUP BY day
+            UNION ALL
+            SELECT 'logins', date(first_login_at, 'unixepoch') AS day, COUNT(*)
+            FROM emby_users WHERE first_login_at >= ? GROUP BY day
+            UNION ALL
+            SELECT 'deleted', date(deleted_at, 'unixepoch') AS day, COUNT(*)
+            FROM emby_users WHERE deleted_at >= ? GROUP BY day
+        ''', (since, since, since))
+        
+        daily: Dict[str, Dict[str, int]] = {}
+        for kind, day, count in cursor.fetchall():
+            daily.setdefault(day, {'created': 0, 'logins': 0, 'deleted': 0})[kind] = count
+        
+        return {
+            'total': total,
+            'active': active,
+            'logged_in': logged_in,
+            'pending': pending,
+            'deleted': deleted,
+            'daily': dict(sorted(daily.items())),
+        }
+    
+    @timed("db")
+    def create_import_job(self, file_name: str, import_dir: str, chat_id: int) -> Tuple[int, str]:
+        """
+        Регистрирует задание импорта
+        
+        Файл задания называется по его ID, поэтому два задания с одним
+        и тем же файлом не удаляют файлы друг друга.
+        
+        Args:
+            file_name: Исходное имя файла
+            import_dir: Папка, в которой сохраняется файл
+            chat_id: Чат, в который отправляются прогресс и отчет
+        
+        Returns:
+            Кортеж (ID задания, путь, по которому нужно сохранить файл)
+        """
+        conn = self.get_connection()
+        with conn:
+            job_id = conn.execute(
+                "INSERT INTO import_jobs (file_name, file_path, chat_id) VALUES (?, '', ?)",
+                (file_name, chat_id)
+            ).lastrowid
+            file_path = os.path.join(import_dir, f"{job_id}_{os.path.basename(file_name)}")
+            conn.execute("UPDATE import_jobs SET file_path = ? WHERE id = ?", (file_path, job_id))
+        logger.info(f"📥 Создано задание импорта {job_id}: {file_name}")
+        return job_id, file_path
+    
+    @timed("db")
+    def get_unfinished_import_jobs(self) -> List[Tuple[int, str, str, int]]:
+        """Получает задания импорта, прерванные остановкой бота: (id, имя файла, путь, чат)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, file_name, file_path, chat_id
+            FROM import_jobs
+            WHERE status = 'running'
+            ORDER BY id
+        ''')
+        return cursor.fetchall()
+    
+    @timed("db")
+    def record_import_rows(self, job_id: int, rows: Iterable[Tuple[int, str, Optional[str], Optional[str]]]) -> List[bool]:
+        """
+        Сохраняет результаты строк импорта одной транзакцией
+        
+        Args:
+            job_id: ID задания
+            rows: Кортежи (номер строки, имя пользователя, ID в Emby, ошибка или None)
+        """
+        return self._execute_batch(
+            '''
+            INSERT OR REPLACE INTO import_rows (job_id, row, username, status, emby_user_id, error)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''',
+            (
+                (job_id, row, username, 'failed' if error else 'created', emby_user_id, error)
+                for row, username, emby_user_id, error in rows
+            )
+        )
+    
+    @timed("db")
+    def get_import_rows(self, job_id: int) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        """Получает обработанные строки задания: (номер строки, имя, ID в Emby, ошибка)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT row, username, emby_user_id, error
+            FROM import_rows
+            WHERE job_id = ?
+            ORDER BY row
+        ''', (job_id,))
+        return cursor.fetchall()
+    
+    @timed("db")
+    def finish_import_job(self, job_id: int, status: str = 'done') -> bool:
+        """Отмечает задание импорта завершенным (done) или прерванным ошибкой (failed)"""
+        return any(self._execute_batch(
+            f"UPDATE import_jobs SET status = ?, finished_at = {EPOCH_NOW_SQL} WHERE id = ?",
+            [(status, job_id)]
+        ))
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обертка над Database для вызова из цикла событий бота
+    
+    Все методы Database доступны как корутины и выполняются вне цикла событий:
+    записи - в единственном потоке-писателе (SQLite все равно допускает одного
+    писателя), чтения из READ_METHODS - в пуле читателей со своими подключениями,
+    которые в режиме WAL не ждут писателя. Медленный диск или долгая пакетная
+    запись не останавливают обработку апдейтов.
+    
+    Проверки прав из кэша администраторов выполняются сразу, без перехода в поток.
+    """
+    
+    READ_METHODS = frozenset({
+        'get_users_to_delete',
+        'get_due_deletion_retries',
+        'get_pending_login_users',
+        'get_due_login_checks',
+        'get_user_by_username',
+        'has_first_login',
+        'get_all_users',
+        'get_emby_user_ids',
+        'get_users_page',
+        'get_user_stats',
+        'get_unfinished_import_jobs',
+        'get_import_rows',
+    })
+    
+    # Методы, которые отвечают из кэша, если он уже загружен:
+    # имя метода -> (атрибут кэша, ответ по снимку кэша и аргументам метода)
+    CACHED_METHODS = {
+        'is_admin': ('_admin_ids', lambda ids, telegram_id: telegram_id in ids),
+        'get_all_admins': ('_admin_ids', lambda ids: list(ids)),
+        'is_admin_group': ('_admin_group_ids', lambda ids, telegram_group_id: telegram_group_id in ids),
+        'get_all_admin_groups': ('_admin_group_ids', lambda ids: list(ids)),
+    }
+    
+    def __init__(self, db: Database, readers: int = DEFAULT_DB_READERS):
+        """
+        Args:
+            db: Синхронная база данных
+            readers: Количество потоков-читателей (0 - все запросы через писателя)
+        """
+        self.db = db
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers: Optional[ThreadPoolExecutor] = None
+        if readers > 0 and db.db_path != ":memory:":
+            self._readers = ThreadPoolExecutor(
+                max_workers=readers,
+                thread_name_prefix="db-reader",
+                initializer=db._open_reader
+            )
+    
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self.db, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+        
+        executor = self._readers if name in self.READ_METHODS and self._readers else self._writer
+        cached = self.CACHED_METHODS.get(name)
+        
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            if cached:
+                # Снимок читается один раз: если писатель сбросит кэш после проверки,
+                # сам метод загрузил бы его заново запросом из потока цикла событий
+                cache_attr, answer = cached
+                snapshot = getattr(self.db, cache_attr)
+                if snapshot is not None:
+                    return answer(snapshot, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+        
+        # Следующие обращения находят обертку в __dict__ без __getattr__
+        self.__dict__[name] = call
+        return call
+    
+    async def close(self):
+        """Дожидается текущих запросов и закрывает подключения к БД"""
+        loop = asyncio.get_running_loop()
+        if self._readers is not None:
+            await loop.run_in_executor(None, functools.partial(self._readers.shutdown, wait=True))
+        await loop.run_in_executor(self._writer, self.db.close)
+        await loop.run_in_executor(None, functools.partial(self._writer.shutdown, wait=True))
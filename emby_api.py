@@ -4,21 +4,360 @@
 """
 
 import requests
-from typing import Dict, List, Optional, Any
+from requests.adapters import HTTPAdapter
+import httpx
+from typing import Dict, List, Optional, Any, Tuple, AsyncIterator, Sequence
+import asyncio
 import logging
+import random
+import threading
+import time
 from datetime import datetime
 
+from metrics import clear_error, mark_error, timed
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 20
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 10.0
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+# Circuit breaker: после стольких ошибок подряд запросы к Emby не выполняются
+# recovery_timeout секунд, затем пропускается один пробный запрос
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30.0
+
+# Повторы идемпотентных запросов с экспоненциальной задержкой и случайным разбросом
+DEFAULT_MAX_RETRIES = 2
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 2.0
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE'})
+
+
+class EmbyUnavailableError(requests.exceptions.RequestException, httpx.HTTPError):
+    """
+    Emby считается недоступным, запрос не выполнялся
+    
+    Наследуется от исключений обоих HTTP клиентов, поэтому обрабатывается
+    теми же except-блоками, что и обычные сетевые ошибки.
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель запросов к Emby
+    
+    closed - запросы идут как обычно; после failure_threshold ошибок подряд
+    переходит в open и сразу отклоняет запросы. Через recovery_timeout секунд
+    пропускается один пробный запрос (half_open): успех закрывает предохранитель,
+    ошибка снова открывает его на recovery_timeout секунд.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        recovery_timeout: float = DEFAULT_RECOVERY_TIMEOUT
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+    
+    def allow_request(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            # Пробный запрос разрешается раз в recovery_timeout, даже если предыдущий
+            # так и не завершился (например, был отменен)
+            if now - self._opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("✅ Emby снова доступен, запросы возобновлены")
+            self.state = self.CLOSED
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logger.warning(
+                        f"⚠️ Emby не отвечает ({self.failures} ошибок подряд), "
+                        f"запросы приостановлены на {self.recovery_timeout:.0f} с"
+                    )
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+    
+    def is_open(self) -> bool:
+        """Запросы сейчас отклоняются (предохранитель открыт и время пробного запроса не наступило)"""
+        return self.state != self.CLOSED and self.retry_after() > 0
+    
+    def retry_after(self) -> float:
+        """Сколько секунд осталось до пробного запроса"""
+        return max(0.0, self._opened_at + self.recovery_timeout - time.monotonic())
+
+
+def retry_delay(attempt: int) -> float:
+    """Задержка перед повтором: случайная в пределах экспоненциально растущего окна (full jitter)"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_server_failure(status_code: int) -> bool:
+    """Ответ говорит о проблеме сервера, а не запроса (404 и другие 4xx - нормальные ответы)"""
+    return status_code >= 500
+
+
+def create_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Создает requests.Session с пулом keep-alive соединений
+    
+    Args:
+        pool_size: Максимальное количество соединений с сервером Emby
+    
+    Returns:
+        Сессия, переиспользующая TCP/TLS соединения между запросами
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def create_async_client(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY
+) -> httpx.AsyncClient:
+    """
+    Создает httpx.AsyncClient с пулом keep-alive соединений
+    
+    Args:
+        pool_size: Максимальное количество соединений с сервером Emby
+        connect_timeout: Таймаут установки соединения в секундах
+        read_timeout: Таймаут ожидания ответа в секундах
+        keepalive_expiry: Сколько секунд держать простаивающее соединение открытым
+    
+    Returns:
+        Асинхронный клиент для AsyncEmbyAPI
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        )
+    )
+
+
+def parse_emby_date(value: Optional[str]) -> Optional[datetime]:
+    """
+    Преобразует дату Emby (ISO 8601, например 2025-10-20T12:34:56.0000000Z) в datetime
+    
+    Args:
+        value: Строка с датой из ответа Emby
+    
+    Returns:
+        Datetime без часового пояса или None если даты нет
+    """
+    if not value:
+        return None
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def build_playback_stats(counts: Dict[str, int], recent_items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Собирает статистику просмотра из серверных счетчиков и последних просмотренных элементов
+    
+    Args:
+        counts: Значения TotalRecordCount для каждого ключа PLAYBACK_COUNTERS
+        recent_items: Элементы из ответа /Users/{id}/Items, отсортированные по дате просмотра
+    
+    Returns:
+        Словарь со статистикой просмотра
+    """
+    stats = dict(counts, recent_items=[])
+    
+    for item in recent_items[:10]:
+        stats['recent_items'].append({
+            'name': item.get('Name'),
+            'type': item.get('Type'),
+            'played_date': item.get('UserData', {}).get('LastPlayedDate')
+        })
+    
+    return stats
+
+
+class _TTLCache:
+    """Простой кэш значений с ограниченным временем жизни"""
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+    
+    def set(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+
+
+EMPTY_PLAYBACK_STATS = {
+    'total_items_played': 0,
+    'movies': 0,
+    'episodes': 0,
+    'recent_items': []
+}
+
+PLAYBACK_STATS_TTL = 300
+
+# Счетчики статистики просмотра: ключ -> тип элементов Emby (None - все типы)
+PLAYBACK_COUNTERS = {
+    'total_items_played': None,
+    'movies': 'Movie',
+    'episodes': 'Episode'
+}
+
+PLAYBACK_BASE_PARAMS = {
+    'Filters': 'IsPlayed',
+    'Recursive': 'true',
+    'IsFolder': 'false',
+    'EnableImages': 'false'
+}
+
+# Последние просмотренные элементы: только имя, тип и данные просмотра
+PLAYBACK_RECENT_PARAMS = dict(
+    PLAYBACK_BASE_PARAMS,
+    SortBy='DatePlayed',
+    SortOrder='Descending',
+    EnableUserData='true',
+    Limit=10
+)
+
+
+# Постраничная выборка пользователей через /Users/Query
+USERS_PAGE_SIZE = 500
+USER_NAME_PREFIX = 'user'
+ACTIVITY_FIELDS = ('Id', 'LastActivityDate')
+NAME_FIELDS = ('Id', 'Name')
+
+
+def users_query_params(start_index: int, limit: int, name_prefix: Optional[str] = None) -> Dict[str, Any]:
+    """Параметры страницы /Users/Query: сервер сам отсекает имена меньше префикса"""
+    params: Dict[str, Any] = {'StartIndex': start_index, 'Limit': limit}
+    if name_prefix:
+        params['NameStartsWithOrGreater'] = name_prefix
+    return params
+
+
+def filter_users_page(
+    users: List[Dict[str, Any]],
+    name_prefix: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Оставляет пользователей с именем на name_prefix и только нужные поля
+    
+    NameStartsWithOrGreater возвращает все имена от префикса и дальше по алфавиту,
+    поэтому точное совпадение префикса проверяется здесь.
+    """
+    if name_prefix:
+        users = [user for user in users if user.get('Name', '').startswith(name_prefix)]
+    if fields:
+        users = [{field: user[field] for field in fields if field in user} for user in users]
+    return users
+
+
+# Массовое обновление политик: сколько запросов выполнять одновременно и итог по пользователю
+DEFAULT_BULK_CONCURRENCY = 8
+POLICY_UPDATED = 'updated'
+POLICY_UNCHANGED = 'unchanged'
+POLICY_FAILED = 'failed'
+
+
+def patch_policy(policy: Dict[str, Any], policy_updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Накладывает изменения на копию политики пользователя
+    
+    Returns:
+        Новая политика или None, если политика уже содержит эти значения
+    """
+    if all(policy.get(key) == value for key, value in policy_updates.items()):
+        return None
+    return dict(policy, **policy_updates)
+
+
+def _log_bulk_policy_results(results: Dict[str, str]):
+    updated = sum(1 for status in results.values() if status == POLICY_UPDATED)
+    failed = sum(1 for status in results.values() if status == POLICY_FAILED)
+    logger.info(
+        f"✅ Политика обновлена у {updated} из {len(results)} пользователей "
+        f"(без изменений: {len(results) - updated - failed}, ошибок: {failed})"
+    )
+
+
+def playback_count_params(item_type: Optional[str]) -> Dict[str, Any]:
+    """
+    Параметры запроса, который возвращает только TotalRecordCount без самих элементов
+    
+    Args:
+        item_type: Тип элементов Emby (Movie, Episode) или None для всех типов
+    """
+    params = dict(PLAYBACK_BASE_PARAMS, Limit=0, EnableUserData='false', EnableTotalRecordCount='true')
+    if item_type:
+        params['IncludeItemTypes'] = item_type
+    return params
+
 
 class EmbyAPI:
-    def __init__(self, server_url: str, api_key: str):
+    """
+    Синхронный клиент Emby API для скриптов и ручного обслуживания
+    
+    Бот использует AsyncEmbyAPI: постраничные снимки, предохранитель с повторами,
+    кэш статистики и массовые операции есть только там.
+    """
+    
+    def __init__(
+        self,
+        server_url: str,
+        api_key: str,
+        session: Optional[requests.Session] = None,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT
+    ):
         """
         Инициализация Emby API клиента
         
         Args:
             server_url: URL сервера Emby (например: http://localhost:8096)
             api_key: API ключ администратора Emby
+            session: Общая сессия с пулом соединений (по умолчанию создается новая)
+            connect_timeout: Таймаут установки соединения в секундах
+            read_timeout: Таймаут ожидания ответа в секундах
         """
         self.server_url = server_url.rstrip('/')
         self.api_key = api_key
@@ -26,7 +365,25 @@ class EmbyAPI:
             'X-Emby-Token': api_key,
             'Content-Type': 'application/json'
         }
+        self.session = session or create_session()
+        self.timeout = (connect_timeout, read_timeout)
+    
+    def close(self):
+        """Закрывает пул соединений"""
+        self.session.close()
     
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Выполняет запрос к Emby через общую сессию и проверяет статус ответа"""
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, f"{self.server_url}{path}", headers=self.headers, **kwargs)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            mark_error()
+            raise
+        return response
+    
+    @timed("emby")
     def create_user(self, username: str, password: str) -> Optional[Dict[str, Any]]:
         """
         Создает нового пользователя в Emby
@@ -39,14 +396,12 @@ class EmbyAPI:
             Словарь с данными пользователя или None в случае ошибки
         """
         try:
-            url = f"{self.server_url}/emby/Users/New"
             data = {
                 "Name": username,
                 "Password": password
             }
             
-            response = requests.post(url, json=data, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            response = self._request("POST", "/emby/Users/New", json=data)
             
             user_data = response.json()
             logger.info(f"✅ Пользователь {username} создан в Emby, ID: {user_data.get('Id')}")
@@ -56,6 +411,7 @@ class EmbyAPI:
             logger.error(f"❌ Ошибка при создании пользователя {username}: {e}")
             return None
     
+    @timed("emby")
     def delete_user(self, user_id: str) -> bool:
         """
         Удаляет пользователя из Emby
@@ -64,20 +420,29 @@ class EmbyAPI:
             user_id: ID пользователя в Emby
         
         Returns:
-            True если удаление успешно, False в случае ошибки
+            True если пользователя больше нет на сервере, False в случае ошибки
         """
         try:
-            url = f"{self.server_url}/emby/Users/{user_id}"
-            response = requests.delete(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            self._request("DELETE", f"/emby/Users/{user_id}")
             
             logger.info(f"✅ Пользователь {user_id} удален из Emby")
             return True
         
+        except requests.exceptions.HTTPError as e:
+            # 404: пользователь уже удален - вручную или запросом, ответ на который
+            # потерялся по таймауту и который был повторен
+            if e.response.status_code != 404:
+                logger.error(f"❌ Ошибка при удалении пользователя {user_id}: {e}")
+                return False
+            clear_error()
+            logger.info(f"✅ Пользователь {user_id} уже удален из Emby")
+            return True
+        
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ Ошибка при удалении пользователя {user_id}: {e}")
             return False
     
+    @timed("emby")
     def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """
         Получает информацию о пользователе по ID
@@ -89,16 +454,14 @@ class EmbyAPI:
             Словарь с данными пользователя или None
         """
         try:
-            url = f"{self.server_url}/emby/Users/{user_id}"
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
-            
+            response = self._request("GET", f"/emby/Users/{user_id}")
             return response.json()
         
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ Ошибка при получении данных пользователя {user_id}: {e}")
             return None
     
+    @timed("emby")
     def get_all_users(self) -> List[Dict[str, Any]]:
         """
         Получает список всех пользователей Emby
@@ -107,11 +470,7 @@ class EmbyAPI:
             Список словарей с данными пользователей
         """
         try:
-            url = f"{self.server_url}/emby/Users"
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
-            
-            users = response.json()
+            users = self._request("GET", "/emby/Users").json()
             logger.info(f"📋 Получено {len(users)} пользователей из Emby")
             return users
         
@@ -119,6 +478,7 @@ class EmbyAPI:
             logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
             return []
     
+    @timed("emby")
     def get_users_starting_with_user(self) -> List[Dict[str, Any]]:
         """
         Получает список пользователей, имена которых начинаются с "user"
@@ -126,11 +486,16 @@ class EmbyAPI:
         Returns:
             Список словарей с данными пользователей
         """
-        all_users = self.get_all_users()
-        user_users = [u for u in all_users if u.get('Name', '').startswith('user')]
-        logger.info(f"📋 Найдено {len(user_users)} пользователей с именами, начинающимися на 'user'")
-        return user_users
+        try:
+            user_users = filter_users_page(self._request("GET", "/emby/Users").json(), USER_NAME_PREFIX)
+            logger.info(f"📋 Найдено {len(user_users)} пользователей с именами, начинающимися на 'user'")
+            return user_users
+        
+        except requests.exceptions.RequestException as e:
+            logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
+            return []
     
+    @timed("emby")
     def check_user_first_login(self, user_id: str) -> Optional[datetime]:
         """
         Проверяет время последней активности пользователя
@@ -147,21 +512,25 @@ class EmbyAPI:
             if not user:
                 return None
             
-            last_activity = user.get('LastActivityDate')
-            if last_activity:
-                login_time = datetime.strptime(last_activity[:19], "%Y-%m-%dT%H:%M:%S")
+            login_time = parse_emby_date(user.get('LastActivityDate'))
+            if login_time:
                 logger.info(f"📅 Пользователь {user_id} последняя активность: {login_time}")
                 return login_time
             
             return None
         
         except Exception as e:
+            mark_error()
             logger.error(f"❌ Ошибка при проверке первого входа пользователя {user_id}: {e}")
             return None
     
+    @timed("emby")
     def get_user_playback_stats(self, user_id: str) -> Dict[str, Any]:
         """
-        Получает статистику просмотра пользователя
+        Получает статистику просмотра пользователя за всю историю
+        
+        Итоги считает сервер (TotalRecordCount при Limit=0), а элементы
+        запрашиваются только для 10 последних просмотров.
         
         Args:
             user_id: ID пользователя в Emby
@@ -170,47 +539,23 @@ class EmbyAPI:
             Словарь со статистикой просмотра
         """
         try:
-            url = f"{self.server_url}/emby/Users/{user_id}/Items"
-            params = {
-                'SortBy': 'DatePlayed',
-                'SortOrder': 'Descending',
-                'Filters': 'IsPlayed',
-                'Recursive': 'true',
-                'Limit': 50
+            path = f"/emby/Users/{user_id}/Items"
+            counts = {
+                key: self._request("GET", path, params=playback_count_params(item_type)).json().get('TotalRecordCount', 0)
+                for key, item_type in PLAYBACK_COUNTERS.items()
             }
+            recent = self._request("GET", path, params=PLAYBACK_RECENT_PARAMS).json().get('Items', [])
             
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            items = data.get('Items', [])
-            
-            stats = {
-                'total_items_played': len(items),
-                'movies': sum(1 for i in items if i.get('Type') == 'Movie'),
-                'episodes': sum(1 for i in items if i.get('Type') == 'Episode'),
-                'recent_items': []
-            }
-            
-            for item in items[:10]:
-                stats['recent_items'].append({
-                    'name': item.get('Name'),
-                    'type': item.get('Type'),
-                    'played_date': item.get('UserData', {}).get('LastPlayedDate')
-                })
+            stats = build_playback_stats(counts, recent)
             
             logger.info(f"📊 Статистика для пользователя {user_id}: {stats['total_items_played']} элементов")
             return stats
         
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ Ошибка при получении статистики пользователя {user_id}: {e}")
-            return {
-                'total_items_played': 0,
-                'movies': 0,
-                'episodes': 0,
-                'recent_items': []
-            }
+            return dict(EMPTY_PLAYBACK_STATS, recent_items=[])
     
+    @timed("emby")
     def update_user_policy(self, user_id: str, policy_updates: Dict[str, Any]) -> bool:
         """
         Обновляет политику пользователя (права доступа)
@@ -231,9 +576,7 @@ class EmbyAPI:
             
             current_policy.update(policy_updates)
             
-            url = f"{self.server_url}/emby/Users/{user_id}/Policy"
-            response = requests.post(url, json=current_policy, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            self._request("POST", f"/emby/Users/{user_id}/Policy", json=current_policy)
             
             logger.info(f"✅ Политика пользователя {user_id} обновлена")
             return True
@@ -242,6 +585,7 @@ class EmbyAPI:
             logger.error(f"❌ Ошибка при обновлении политики пользователя {user_id}: {e}")
             return False
     
+    @timed("emby")
     def test_connection(self) -> bool:
         """
         Тестирует подключение к Emby серверу
@@ -250,9 +594,7 @@ class EmbyAPI:
             True если подключение успешно, False в случае ошибки
         """
         try:
-            url = f"{self.server_url}/emby/System/Info"
-            response = requests.get(url, headers=self.headers, timeout=5)
-            response.raise_for_status()
+            response = self._request("GET", "/emby/System/Info", timeout=(self.timeout[0], 5))
             
             info = response.json()
             logger.info(f"✅ Подключение к Emby успешно: {info.get('ServerName')} v{info.get('Version')}")
@@ -261,3 +603,497 @@ class EmbyAPI:
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ Ошибка подключения к Emby: {e}")
             return False
+
+
+class AsyncEmbyAPI:
+    """
+    Асинхронный клиент Emby API
+    
+    Основной клиент бота: не блокирует цикл событий, все запросы выполняются
+    через общий пул соединений httpx.AsyncClient.
+    """
+    
+    def __init__(
+        self,
+        server_url: str,
+        api_key: str,
+        client: Optional[httpx.AsyncClient] = None,
+        playback_stats_ttl: float = PLAYBACK_STATS_TTL,
+        breaker: Optional[CircuitBreaker] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES
+    ):
+        """
+        Инициализация асинхронного Emby API клиента
+        
+        Args:
+            server_url: URL сервера Emby (например: http://localhost:8096)
+            api_key: API ключ администратора Emby
+            client: Общий клиент с пулом соединений (см. create_async_client)
+            playback_stats_ttl: Сколько секунд хранить статистику просмотра в кэше
+            breaker: Предохранитель запросов (по умолчанию создается новый)
+            max_retries: Сколько раз повторять идемпотентные запросы после ошибки сервера
+        """
+        self.server_url = server_url.rstrip('/')
+        self.api_key = api_key
+        self.headers = {
+            'X-Emby-Token': api_key,
+            'Content-Type': 'application/json'
+        }
+        self.client = client or create_async_client()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self._playback_cache = _TTLCache(playback_stats_ttl)
+        self._users_query_supported = True
+    
+    async def close(self):
+        """Закрывает пул соединений"""
+        await self.client.aclose()
+    
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Выполняет запрос к Emby и проверяет статус ответа
+        
+        Пока предохранитель открыт, сразу выбрасывает EmbyUnavailableError.
+        Идемпотентные запросы повторяются после сетевых ошибок и ответов 5xx.
+        """
+        url = f"{self.server_url}{path}"
+        attempts = 1 + (self.max_retries if method in IDEMPOTENT_METHODS else 0)
+        
+        for attempt in range(attempts):
+            if not self.breaker.allow_request():
+                mark_error()
+                raise EmbyUnavailableError(f"Emby недоступен, повтор через {self.breaker.retry_after():.0f} с")
+            try:
+                response = await self.client.request(method, url, headers=self.headers, **kwargs)
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                if not is_server_failure(e.response.status_code):
+                    self.breaker.record_success()
+                    mark_error()
+                    raise
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    mark_error()
+                    raise
+            except httpx.HTTPError:
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    mark_error()
+                    raise
+            else:
+                self.breaker.record_success()
+                return response
+            await asyncio.sleep(retry_delay(attempt))
+    
+    @timed("emby")
+    async def create_user(self, username: str, password: str) -> Optional[Dict[str, Any]]:
+        """
+        Создает нового пользователя в Emby
+        
+        Args:
+            username: Имя пользователя (должно начинаться с "user")
+            password: Пароль пользователя
+        
+        Returns:
+            Словарь с данными пользователя или None в случае ошибки
+        
+        Raises:
+            EmbyUnavailableError: предохранитель открыт и запрос не отправлялся -
+                создание можно безопасно повторить позже
+        """
+        try:
+            data = {
+                "Name": username,
+                "Password": password
+            }
+            
+            response = await self._request("POST", "/emby/Users/New", json=data)
+            
+            user_data = response.json()
+            logger.info(f"✅ Пользователь {username} создан в Emby, ID: {user_data.get('Id')}")
+            return user_data
+        
+        except EmbyUnavailableError:
+            raise
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при создании пользователя {username}: {e}")
+            return None
+    
+    @timed("emby")
+    async def delete_user(self, user_id: str) -> bool:
+        """
+        Удаляет пользователя из Emby
+        
+        Args:
+            user_id: ID пользователя в Emby
+        
+        Returns:
+            True если пользователя больше нет на сервере, False в случае ошибки
+        """
+        try:
+            await self._request("DELETE", f"/emby/Users/{user_id}")
+            
+            logger.info(f"✅ Пользователь {user_id} удален из Emby")
+            return True
+        
+        except httpx.HTTPStatusError as e:
+            # 404: пользователь уже удален - вручную или запросом, ответ на который
+            # потерялся по таймауту и который был повторен
+            if e.response.status_code != 404:
+                logger.error(f"❌ Ошибка при удалении пользователя {user_id}: {e}")
+                return False
+            clear_error()
+            logger.info(f"✅ Пользователь {user_id} уже удален из Emby")
+            return True
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при удалении пользователя {user_id}: {e}")
+            return False
+    
+    @timed("emby")
+    async def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Получает информацию о пользователе по ID
+        
+        Args:
+            user_id: ID пользователя в Emby
+        
+        Returns:
+            Словарь с данными пользователя или None
+        """
+        try:
+            response = await self._request("GET", f"/emby/Users/{user_id}")
+            return response.json()
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении данных пользователя {user_id}: {e}")
+            return None
+    
+    @timed("emby")
+    async def user_exists(self, user_id: str) -> Optional[bool]:
+        """
+        Проверяет, есть ли пользователь на сервере
+        
+        Returns:
+            True если есть, False если сервер ответил 404, None при ошибке запроса
+        """
+        try:
+            await self._request("GET", f"/emby/Users/{user_id}")
+            return True
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                clear_error()
+                return False
+            logger.error(f"❌ Ошибка при проверке пользователя {user_id}: {e}")
+            return None
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при проверке пользователя {user_id}: {e}")
+            return None
+    
+    @timed("emby", "query_users_page")
+    async def _query_users_page(self, start_index: int, limit: int, name_prefix: Optional[str] = None) -> Dict[str, Any]:
+        """Запрашивает одну страницу /Users/Query"""
+        response = await self._request("GET", "/emby/Users/Query", params=users_query_params(start_index, limit, name_prefix))
+        return response.json()
+    
+    async def iter_user_pages(
+        self,
+        name_prefix: Optional[str] = None,
+        page_size: int = USERS_PAGE_SIZE,
+        fields: Optional[Sequence[str]] = None
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Постранично выдает пользователей Emby
+        
+        Фильтр по имени и разбиение на страницы выполняются на сервере
+        (/Users/Query), следующая страница запрашивается только когда нужна.
+        Если сервер не поддерживает /Users/Query, один раз загружается полный список.
+        
+        Args:
+            name_prefix: Только пользователи, имя которых начинается с префикса
+            page_size: Пользователей на странице
+            fields: Оставить в словарях только эти поля (например, Id и Name)
+        
+        Yields:
+            Непустые списки пользователей
+        
+        Raises:
+            httpx.HTTPError: при ошибке запроса
+        """
+        start_index = 0
+        while self._users_query_supported:
+            try:
+                data = await self._query_users_page(start_index, page_size, name_prefix)
+            except httpx.HTTPStatusError as e:
+                if start_index > 0 or e.response.status_code != 404:
+                    raise
+                self._users_query_supported = False
+                logger.warning("⚠️ Сервер Emby не поддерживает /Users/Query, используется полный список пользователей")
+                break
+            
+            items = data.get('Items') or []
+            page = filter_users_page(items, name_prefix, fields)
+            if page:
+                yield page
+            start_index += len(items)
+            if not items or start_index >= data.get('TotalRecordCount', 0):
+                return
+        
+        response = await self._request("GET", "/emby/Users")
+        users = filter_users_page(response.json(), name_prefix, fields)
+        for start in range(0, len(users), page_size):
+            yield users[start:start + page_size]
+    
+    @timed("emby")
+    async def get_all_users(self) -> List[Dict[str, Any]]:
+        """
+        Получает список всех пользователей Emby
+        
+        Returns:
+            Список словарей с данными пользователей
+        """
+        try:
+            users = [user async for page in self.iter_user_pages() for user in page]
+            logger.info(f"📋 Получено {len(users)} пользователей из Emby")
+            return users
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
+            return []
+    
+    @timed("emby")
+    async def get_users_starting_with_user(self) -> List[Dict[str, Any]]:
+        """
+        Получает список пользователей, имена которых начинаются с "user"
+        
+        Returns:
+            Список словарей с данными пользователей
+        """
+        try:
+            user_users = [user async for page in self.iter_user_pages(USER_NAME_PREFIX) for user in page]
+            logger.info(f"📋 Найдено {len(user_users)} пользователей с именами, начинающимися на 'user'")
+            return user_users
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
+            return []
+    
+    @timed("emby")
+    async def get_user_name_map(self, name_prefix: str = USER_NAME_PREFIX) -> Optional[Dict[str, str]]:
+        """
+        Получает снимок {ID пользователя: имя} для сверки с БД
+        
+        Returns:
+            Словарь или None при ошибке запроса (в отличие от пустого списка,
+            который означает, что таких пользователей на сервере нет)
+        """
+        try:
+            return {
+                user['Id']: user['Name']
+                async for page in self.iter_user_pages(name_prefix, fields=NAME_FIELDS)
+                for user in page
+            }
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
+            return None
+    
+    @timed("emby")
+    async def get_last_activity_map(self) -> Optional[Dict[str, datetime]]:
+        """
+        Получает время последней активности пользователей 'user*' постранично
+        
+        Returns:
+            Словарь {ID пользователя: время последней активности} только для тех, кто входил,
+            или None при ошибке запроса (неполный снимок не возвращается)
+        """
+        activity = {}
+        try:
+            async for page in self.iter_user_pages(USER_NAME_PREFIX, fields=ACTIVITY_FIELDS):
+                for user in page:
+                    login_time = parse_emby_date(user.get('LastActivityDate'))
+                    if login_time:
+                        activity[user.get('Id')] = login_time
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении активности пользователей: {e}")
+            return None
+        return activity
+    
+    @timed("emby")
+    async def check_user_first_login(self, user_id: str) -> Optional[datetime]:
+        """
+        Проверяет время последней активности пользователя
+        
+        Args:
+            user_id: ID пользователя в Emby
+        
+        Returns:
+            Datetime первого входа или None если пользователь не входил
+            или его больше нет на сервере (404)
+        
+        Raises:
+            httpx.HTTPError: при ошибке запроса - чтобы ее нельзя было принять за "еще не входил"
+        """
+        try:
+            user = (await self._request("GET", f"/emby/Users/{user_id}")).json()
+        except httpx.HTTPStatusError as e:
+            # Как и в снимке get_last_activity_map, удаленный пользователь - это
+            # проверка без входа, а не ошибка, иначе его проверка не переносилась бы
+            if e.response.status_code != 404:
+                logger.error(f"❌ Ошибка при проверке первого входа пользователя {user_id}: {e}")
+                raise
+            clear_error()
+            logger.warning(f"⚠️ Пользователь {user_id} не найден в Emby")
+            return None
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при проверке первого входа пользователя {user_id}: {e}")
+            raise
+        
+        login_time = parse_emby_date(user.get('LastActivityDate'))
+        if login_time:
+            logger.info(f"📅 Пользователь {user_id} последняя активность: {login_time}")
+        return login_time
+    
+    @timed("emby")
+    async def get_user_playback_stats(self, user_id: str, use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Получает статистику просмотра пользователя за всю историю
+        
+        Счетчики и последние просмотры запрашиваются параллельно,
+        результат кэшируется на playback_stats_ttl секунд.
+        
+        Args:
+            user_id: ID пользователя в Emby
+            use_cache: Вернуть значение из кэша, если оно еще актуально
+        
+        Returns:
+            Словарь со статистикой просмотра
+        """
+        cached = self._playback_cache.get(user_id) if use_cache else None
+        if cached is not None:
+            return cached
+        
+        try:
+            path = f"/emby/Users/{user_id}/Items"
+            *count_responses, recent_response = await asyncio.gather(
+                *(self._request("GET", path, params=playback_count_params(item_type))
+                  for item_type in PLAYBACK_COUNTERS.values()),
+                self._request("GET", path, params=PLAYBACK_RECENT_PARAMS)
+            )
+            counts = {
+                key: response.json().get('TotalRecordCount', 0)
+                for key, response in zip(PLAYBACK_COUNTERS, count_responses)
+            }
+            
+            stats = build_playback_stats(counts, recent_response.json().get('Items', []))
+            self._playback_cache.set(user_id, stats)
+            
+            logger.info(f"📊 Статистика для пользователя {user_id}: {stats['total_items_played']} элементов")
+            return stats
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при получении статистики пользователя {user_id}: {e}")
+            return dict(EMPTY_PLAYBACK_STATS, recent_items=[])
+    
+    @timed("emby")
+    async def update_user_policy(self, user_id: str, policy_updates: Dict[str, Any]) -> bool:
+        """
+        Обновляет политику пользователя (права доступа)
+        
+        Args:
+            user_id: ID пользователя в Emby
+            policy_updates: Словарь с обновлениями политики
+        
+        Returns:
+            True если обновление успешно, False в случае ошибки
+        """
+        try:
+            user = await self.get_user_by_id(user_id)
+            if not user:
+                return False
+            
+            current_policy = user.get('Policy', {})
+            current_policy.update(policy_updates)
+            
+            await self._request("POST", f"/emby/Users/{user_id}/Policy", json=current_policy)
+            
+            logger.info(f"✅ Политика пользователя {user_id} обновлена")
+            return True
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка при обновлении политики пользователя {user_id}: {e}")
+            return False
+    
+    @timed("emby")
+    async def bulk_update_policy(
+        self,
+        policy_updates: Dict[str, Any],
+        users: Optional[List[Dict[str, Any]]] = None,
+        concurrency: int = DEFAULT_BULK_CONCURRENCY
+    ) -> Dict[str, str]:
+        """
+        Обновляет политику многих пользователей параллельно
+        
+        Текущие политики берутся из снимка списка пользователей (GET /Users
+        возвращает их вместе с пользователями), поэтому на каждого пользователя
+        нужен один POST вместо GET + POST. Пользователи, у которых политика
+        уже содержит нужные значения, пропускаются.
+        
+        Args:
+            policy_updates: Словарь с обновлениями политики
+            users: Снимок пользователей из get_all_users (по умолчанию запрашивается)
+            concurrency: Максимальное число одновременных запросов
+        
+        Returns:
+            Словарь {ID пользователя: POLICY_UPDATED, POLICY_UNCHANGED или POLICY_FAILED}
+        """
+        if users is None:
+            users = await self.get_all_users()
+        
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        
+        async def update(user: Dict[str, Any]) -> Tuple[str, str]:
+            user_id = user.get('Id')
+            try:
+                async with semaphore:
+                    policy = user.get('Policy')
+                    if policy is None:
+                        full_user = await self.get_user_by_id(user_id)
+                        if not full_user:
+                            return user_id, POLICY_FAILED
+                        policy = full_user.get('Policy', {})
+                    
+                    new_policy = patch_policy(policy, policy_updates)
+                    if new_policy is None:
+                        return user_id, POLICY_UNCHANGED
+                    
+                    await self._request("POST", f"/emby/Users/{user_id}/Policy", json=new_policy)
+                    return user_id, POLICY_UPDATED
+            
+            except httpx.HTTPError as e:
+                logger.error(f"❌ Ошибка при обновлении политики пользователя {user_id}: {e}")
+                return user_id, POLICY_FAILED
+        
+        results = dict(await asyncio.gather(*(update(user) for user in users)))
+        
+        _log_bulk_policy_results(results)
+        return results
+    
+    @timed("emby")
+    async def test_connection(self) -> bool:
+        """
+        Тестирует подключение к Emby серверу
+        
+        Returns:
+            True если подключение успешно, False в случае ошибки
+        """
+        try:
+            response = await self._request("GET", "/emby/System/Info", timeout=httpx.Timeout(5, connect=self.client.timeout.connect))
+            
+            info = response.json()
+            logger.info(f"✅ Подключение к Emby успешно: {info.get('ServerName')} v{info.get('Version')}")
+            return True
+        
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Ошибка подключения к Emby: {e}")
+            return False
@@ -0,0 +1,188 @@
+"""
+Модуль получения событий Emby через WebSocket
+Сообщает о входах пользователей сразу, без ожидания периодической проверки
+"""
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from urllib.parse import urlencode
+
+from emby_api import parse_emby_date
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+logger = logging.getLogger(__name__)
+
+DEVICE_ID = "emby-telegram-bot"
+DEFAULT_RECONNECT_DELAY = 5.0
+MAX_RECONNECT_DELAY = 300.0
+# Сколько секунд не передавать в on_login пользователя, вход которого не удалось записать
+DEFAULT_UNKNOWN_TTL = 60.0
+
+# Подписки: сервер присылает список сессий и записи журнала активности
+SUBSCRIPTIONS = (
+    {"MessageType": "SessionsStart", "Data": "0,1500"},
+    {"MessageType": "ActivityLogEntryStart", "Data": "0,1000"},
+)
+
+LoginCallback = Callable[[str, datetime], Awaitable[bool]]
+
+
+def build_websocket_url(server_url: str, api_key: str) -> str:
+    """
+    Формирует адрес WebSocket Emby по HTTP адресу сервера
+
+    Args:
+        server_url: URL сервера Emby (например: http://localhost:8096)
+        api_key: API ключ администратора Emby
+    """
+    base = server_url.rstrip('/')
+    if base.startswith('https://'):
+        base = 'wss://' + base[len('https://'):]
+    elif base.startswith('http://'):
+        base = 'ws://' + base[len('http://'):]
+    return f"{base}/embywebsocket?{urlencode({'api_key': api_key, 'deviceId': DEVICE_ID})}"
+
+
+class EmbyEventListener:
+    """
+    Слушает WebSocket Emby и вызывает on_login при активности пользователя
+
+    Источники: сообщения Sessions (UserId и LastActivityDate каждой сессии)
+    и записи журнала AuthenticationSucceeded. Пользователь, для которого
+    on_login вернул True (вход записан), больше не обрабатывается за время
+    работы процесса; иначе - например, его нет в БД или бот его не отслеживает -
+    вход будет передан снова не раньше чем через unknown_ttl секунд: Sessions
+    приходят каждые 1.5 с, и без паузы каждое сообщение обращалось бы к БД.
+    При обрыве соединения подключается заново с экспоненциальной задержкой.
+    """
+
+    def __init__(
+        self,
+        ws_url: str,
+        on_login: LoginCallback,
+        reconnect_delay: float = DEFAULT_RECONNECT_DELAY,
+        max_reconnect_delay: float = MAX_RECONNECT_DELAY,
+        unknown_ttl: float = DEFAULT_UNKNOWN_TTL
+    ):
+        """
+        Args:
+            ws_url: Адрес WebSocket (см. build_websocket_url)
+            on_login: Корутина (ID пользователя Emby, время входа) -> записан ли вход
+            reconnect_delay: Начальная задержка переподключения в секундах
+            max_reconnect_delay: Максимальная задержка переподключения в секундах
+            unknown_ttl: Пауза в секундах перед повторной передачей незаписанного входа
+        """
+        self.ws_url = ws_url
+        self.on_login = on_login
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.unknown_ttl = unknown_ttl
+        self.connected = False
+        self._seen: Set[str] = set()
+        self._unknown: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def is_available() -> bool:
+        """Установлена ли библиотека websockets"""
+        return websockets is not None
+
+    def start(self) -> asyncio.Task:
+        """Запускает прослушивание в фоновой задаче"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        """Останавливает прослушивание"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        """Подключается к Emby и обрабатывает события, переподключаясь при ошибках"""
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with websockets.connect(self.ws_url) as ws:
+                    self.connected = True
+                    delay = self.reconnect_delay
+                    logger.info("🔌 Подключено к WebSocket Emby")
+                    for subscription in SUBSCRIPTIONS:
+                        await ws.send(json.dumps(subscription))
+                    await self._listen(ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Соединение с WebSocket Emby потеряно: {e}")
+            finally:
+                self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _listen(self, ws):
+        """Читает сообщения до закрытия соединения, отвечая на запросы keep-alive"""
+        keepalive_task = None
+        try:
+            async for raw in ws:
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    continue
+                if message.get("MessageType") == "ForceKeepAlive" and keepalive_task is None:
+                    interval = max(float(message.get("Data") or 60) / 2, 1.0)
+                    keepalive_task = asyncio.create_task(self._keepalive(ws, interval))
+                    continue
+                await self.handle_message(message)
+        finally:
+            if keepalive_task is not None:
+                keepalive_task.cancel()
+
+    @staticmethod
+    async def _keepalive(ws, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await ws.send(json.dumps({"MessageType": "KeepAlive"}))
+
+    async def handle_message(self, message: Dict[str, Any]):
+        """Извлекает входы пользователей из сообщения Emby"""
+        message_type = message.get("MessageType")
+        data = message.get("Data") or []
+
+        if message_type == "Sessions":
+            for session in data:
+                await self._report(session.get("UserId"), session.get("LastActivityDate"))
+        elif message_type == "ActivityLogEntry":
+            for entry in data:
+                if entry.get("Type") == "AuthenticationSucceeded":
+                    await self._report(entry.get("UserId"), entry.get("Date"))
+
+    async def _report(self, user_id: Optional[str], date: Optional[str]):
+        if not user_id or user_id in self._seen:
+            return
+        now = time.monotonic()
+        if self._unknown.get(user_id, 0.0) > now:
+            return
+        login_time = parse_emby_date(date)
+        if login_time is None:
+            return
+        try:
+            if await self.on_login(user_id, login_time):
+                self._seen.add(user_id)
+                self._unknown.pop(user_id, None)
+            else:
+                self._unknown[user_id] = now + self.unknown_ttl
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки входа пользователя {user_id}: {e}")
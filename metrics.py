@@ -0,0 +1,219 @@
+"""
+Модуль метрик
+Считает вызовы, ошибки и задержки EmbyAPI, Database и обработчиков бота
+и отдает их в текстовом формате Prometheus
+"""
+
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "emby_bot"
+
+# Границы корзин гистограммы задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Флаг ошибки текущего вызова: методы, которые перехватывают исключения
+# и возвращают None/False, отмечают ошибку через mark_error()
+_current_call: ContextVar[Optional[List[bool]]] = ContextVar("metrics_current_call", default=None)
+
+
+class _Series:
+    """Счетчики и гистограмма одной операции"""
+
+    __slots__ = ("calls", "errors", "total", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float, error: bool):
+        self.calls += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по гистограмме (верхняя граница корзины)"""
+        if not self.calls:
+            return 0.0
+        rank = q * self.calls
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Хранилище метрик, безопасное для вызова из нескольких потоков"""
+
+    def __init__(self):
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, component: str, operation: str, seconds: float, error: bool = False):
+        """Записывает один вызов операции"""
+        with self._lock:
+            series = self._series.get((component, operation))
+            if series is None:
+                series = self._series[(component, operation)] = _Series()
+            series.observe(seconds, error)
+
+    def timed(self, component: str, operation: Optional[str] = None) -> Callable:
+        """
+        Декоратор: измеряет время выполнения функции или корутины
+
+        Ошибкой считается исключение или вызов mark_error() внутри функции.
+
+        Args:
+            component: Компонент (emby, db, handler, job)
+            operation: Имя операции (по умолчанию имя функции)
+        """
+        def decorator(func):
+            name = operation or func.__name__
+
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    flag = [False]
+                    token = _current_call.set(flag)
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    except BaseException:
+                        flag[0] = True
+                        raise
+                    finally:
+                        _current_call.reset(token)
+                        self.observe(component, name, time.perf_counter() - start, flag[0])
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                flag = [False]
+                token = _current_call.set(flag)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except BaseException:
+                    flag[0] = True
+                    raise
+                finally:
+                    _current_call.reset(token)
+                    self.observe(component, name, time.perf_counter() - start, flag[0])
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        """Удаляет все накопленные метрики"""
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self) -> List[Tuple[str, str, int, int, float, float, float]]:
+        """
+        Возвращает сводку по всем операциям
+
+        Returns:
+            Список (компонент, операция, вызовы, ошибки, среднее, p50, p99), время в секундах
+        """
+        with self._lock:
+            return [
+                (component, operation, s.calls, s.errors, s.total / s.calls if s.calls else 0.0,
+                 s.quantile(0.5), s.quantile(0.99))
+                for (component, operation), s in sorted(self._series.items())
+            ]
+
+    def render_prometheus(self) -> str:
+        """Формирует метрики в текстовом формате Prometheus"""
+        lines = [
+            f"# HELP {METRIC_PREFIX}_calls_total Количество вызовов",
+            f"# TYPE {METRIC_PREFIX}_calls_total counter",
+        ]
+        with self._lock:
+            items = sorted(self._series.items())
+            for (component, operation), s in items:
+                lines.append(f'{METRIC_PREFIX}_calls_total{{component="{component}",operation="{operation}"}} {s.calls}')
+
+            lines.append(f"# HELP {METRIC_PREFIX}_errors_total Количество ошибок")
+            lines.append(f"# TYPE {METRIC_PREFIX}_errors_total counter")
+            for (component, operation), s in items:
+                lines.append(f'{METRIC_PREFIX}_errors_total{{component="{component}",operation="{operation}"}} {s.errors}')
+
+            lines.append(f"# HELP {METRIC_PREFIX}_latency_seconds Время выполнения")
+            lines.append(f"# TYPE {METRIC_PREFIX}_latency_seconds histogram")
+            for (component, operation), s in items:
+                labels = f'component="{component}",operation="{operation}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, s.buckets):
+                    cumulative += count
+                    lines.append(f'{METRIC_PREFIX}_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}_latency_seconds_bucket{{{labels},le="+Inf"}} {s.calls}')
+                lines.append(f'{METRIC_PREFIX}_latency_seconds_sum{{{labels}}} {s.total:.6f}')
+                lines.append(f'{METRIC_PREFIX}_latency_seconds_count{{{labels}}} {s.calls}')
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str):
+        """Атомарно записывает метрики в файл (для node_exporter textfile collector)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Запускает HTTP сервер с эндпоинтом /metrics в фоновом потоке"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"📈 Метрики доступны по адресу http://{host}:{port}/metrics")
+        return server
+
+
+def mark_error():
+    """Отмечает текущий измеряемый вызов как завершившийся ошибкой"""
+    flag = _current_call.get()
+    if flag is not None:
+        flag[0] = True
+
+
+def clear_error():
+    """Снимает отметку ошибки с текущего вызова, если ошибка оказалась ожидаемой"""
+    flag = _current_call.get()
+    if flag is not None:
+        flag[0] = False
+
+
+registry = MetricsRegistry()
+timed = registry.timed
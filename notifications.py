@@ -0,0 +1,165 @@
+"""
+Модуль рассылки уведомлений администраторам
+Отправляет сообщения параллельно с учетом лимитов Telegram и повторяет их после RetryAfter
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду всего, 1 в секунду в личный чат, 20 в минуту в группу
+GLOBAL_RATE = 25
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+DEFAULT_CONCURRENCY = 10
+MAX_RETRIES = 3
+MAX_MESSAGE_LENGTH = 4096
+
+
+class _RateLimiter:
+    """Равномерно распределяет события во времени: не чаще одного раза в interval секунд"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Общий лимит бота для всех диспетчеров процесса: задачи удаления, повторов
+# и сверки создают свои диспетчеры и могут отправлять одновременно
+_global_limiter = _RateLimiter(1.0 / GLOBAL_RATE)
+
+
+def split_message(text: str) -> List[str]:
+    """Делит длинный текст на части не длиннее лимита Telegram, по возможности по строкам"""
+    chunks = []
+    while len(text) > MAX_MESSAGE_LENGTH:
+        cut = text.rfind('\n', 0, MAX_MESSAGE_LENGTH)
+        if cut <= 0:
+            cut = MAX_MESSAGE_LENGTH
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class NotificationDispatcher:
+    """
+    Очередь уведомлений с параллельной отправкой
+
+    Сообщения копятся через add() и отправляются в flush(): разные чаты
+    обслуживаются параллельно, сообщения одного чата - по очереди с паузой,
+    а общий поток всех диспетчеров ограничен глобальным лимитом бота.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_retries: int = MAX_RETRIES
+    ):
+        """
+        Args:
+            bot: Экземпляр Telegram бота
+            concurrency: Сколько чатов обслуживать одновременно
+            max_retries: Сколько раз повторять отправку после временной ошибки
+        """
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._queue: Dict[int, List[str]] = OrderedDict()
+
+    def add(self, chat_id: int, text: str):
+        """Ставит сообщение в очередь для чата"""
+        self._queue.setdefault(chat_id, []).append(text)
+
+    def add_many(self, chat_ids: List[int], text: str):
+        """Ставит одно и то же сообщение в очередь для нескольких чатов"""
+        for chat_id in chat_ids:
+            self.add(chat_id, text)
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        """Отправляет одно сообщение, повторяя его после RetryAfter и сетевых ошибок"""
+        for attempt in range(self.max_retries + 1):
+            await _global_limiter.wait()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"⚠️ Лимит Telegram для чата {chat_id}, повтор через {retry_after} с")
+                await asyncio.sleep(retry_after)
+            except (BadRequest, Forbidden) as e:
+                logger.error(f"❌ Ошибка отправки уведомления в чат {chat_id}: {e}")
+                return False
+            except TelegramError as e:
+                logger.warning(f"⚠️ Ошибка отправки уведомления в чат {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        logger.error(f"❌ Не удалось отправить уведомление в чат {chat_id} после {self.max_retries + 1} попыток")
+        return False
+
+    async def _send_chat(self, chat_id: int, texts: List[str], semaphore: asyncio.Semaphore) -> Tuple[int, int]:
+        """Отправляет сообщения одного чата по очереди с учетом лимита на чат"""
+        interval = GROUP_CHAT_INTERVAL if chat_id < 0 else PRIVATE_CHAT_INTERVAL
+        chat_limiter = _RateLimiter(interval)
+        sent = 0
+        async with semaphore:
+            for text in texts:
+                await chat_limiter.wait()
+                if await self._send(chat_id, text):
+                    sent += 1
+        return sent, len(texts) - sent
+
+    async def flush(
+        self,
+        digest: bool = False,
+        digest_title: Optional[str] = None,
+        digest_separator: str = "\n\n"
+    ) -> Tuple[int, int]:
+        """
+        Отправляет все накопленные сообщения и очищает очередь
+
+        Args:
+            digest: Объединить сообщения каждого чата в одну сводку
+            digest_title: Заголовок сводки
+            digest_separator: Разделитель сообщений внутри сводки
+
+        Returns:
+            Кортеж (отправлено, не отправлено)
+        """
+        queue, self._queue = self._queue, OrderedDict()
+        if not queue:
+            return 0, 0
+
+        if digest:
+            for chat_id, texts in queue.items():
+                body = digest_separator.join(texts)
+                queue[chat_id] = split_message(f"{digest_title}\n\n{body}" if digest_title else body)
+
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+        results = await asyncio.gather(
+            *(self._send_chat(chat_id, texts, semaphore) for chat_id, texts in queue.items())
+        )
+
+        sent = sum(r[0] for r in results)
+        failed = sum(r[1] for r in results)
+        logger.info(f"📨 Уведомления отправлены: {sent}, ошибок: {failed}")
+        return sent, failed
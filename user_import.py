@@ -0,0 +1,254 @@
+"""
+Модуль массового создания пользователей Emby
+Потоково читает Excel/CSV файлы и создает пользователей параллельно
+с ограничением числа одновременных запросов
+"""
+
+import asyncio
+import csv
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from openpyxl import load_workbook
+
+from database import AsyncDatabase
+from emby_api import AsyncEmbyAPI, EmbyUnavailableError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PROGRESS_INTERVAL = 5.0
+DB_BATCH_SIZE = 100
+# Минимальная пауза перед повтором, пока предохранитель Emby открыт
+MIN_UNAVAILABLE_DELAY = 1.0
+
+
+class MissingColumnsError(ValueError):
+    """В первой строке файла нет заголовков 'user' и 'pass'"""
+
+
+def _find_columns(header: Sequence[Any]) -> Tuple[int, int]:
+    """Возвращает индексы колонок 'user' и 'pass' в строке заголовков"""
+    user_col = None
+    pass_col = None
+
+    for col, value in enumerate(header):
+        name = str(value).strip().lower() if value else ""
+        if name == "user":
+            user_col = col
+        elif name == "pass":
+            pass_col = col
+
+    if user_col is None or pass_col is None:
+        raise MissingColumnsError("Не найдены колонки 'user' и 'pass'")
+    return user_col, pass_col
+
+
+def _validate_rows(
+    rows: Iterator[Sequence[Any]],
+    user_col: int,
+    pass_col: int,
+    skipped: Optional[List[str]]
+) -> Iterator[Tuple[str, str]]:
+    """Пропускает пустые строки и имена, не начинающиеся с 'user'"""
+    for values in rows:
+        username = values[user_col] if user_col < len(values) else None
+        password = values[pass_col] if pass_col < len(values) else None
+
+        if not username or not password:
+            continue
+
+        username = str(username).strip()
+        password = str(password).strip()
+
+        if not username.startswith("user"):
+            if skipped is not None:
+                skipped.append(username)
+            continue
+
+        yield username, password
+
+
+def _iter_xlsx(file_path: str, skipped: Optional[List[str]]) -> Iterator[Tuple[str, str]]:
+    """Читает лист Excel построчно в режиме read-only"""
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        user_col, pass_col = _find_columns(next(rows, ()))
+    except Exception:
+        workbook.close()
+        raise
+
+    def generate():
+        try:
+            yield from _validate_rows(rows, user_col, pass_col, skipped)
+        finally:
+            workbook.close()
+
+    return generate()
+
+
+def _iter_csv(file_path: str, skipped: Optional[List[str]]) -> Iterator[Tuple[str, str]]:
+    """Читает CSV файл построчно, разделитель (запятая или точка с запятой) определяется автоматически"""
+    file = open(file_path, newline='', encoding='utf-8-sig')
+    try:
+        try:
+            dialect = csv.Sniffer().sniff(file.read(4096), delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        file.seek(0)
+        rows = csv.reader(file, dialect)
+        user_col, pass_col = _find_columns(next(rows, []))
+    except Exception:
+        file.close()
+        raise
+
+    def generate():
+        with file:
+            yield from _validate_rows(rows, user_col, pass_col, skipped)
+
+    return generate()
+
+
+def iter_credentials(file_path: str, skipped: Optional[List[str]] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Потоково читает пары (имя пользователя, пароль) из Excel или CSV файла
+
+    Заголовки проверяются сразу, а строки читаются лениво по одной,
+    поэтому потребление памяти не зависит от размера файла.
+
+    Args:
+        file_path: Путь к .xlsx или .csv файлу
+        skipped: Список, в который добавляются имена, не начинающиеся с 'user'
+
+    Returns:
+        Генератор валидных пар (имя пользователя, пароль)
+
+    Raises:
+        MissingColumnsError: если в первой строке нет колонок 'user' и 'pass'
+    """
+    if file_path.lower().endswith('.csv'):
+        return _iter_csv(file_path, skipped)
+    return _iter_xlsx(file_path, skipped)
+
+
+class ImportRowResult(NamedTuple):
+    """Результат создания одного пользователя"""
+    row: int
+    username: str
+    emby_user_id: Optional[str]
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+ProgressCallback = Callable[[int, int, int], Awaitable[None]]
+
+
+async def create_users(
+    emby_api: AsyncEmbyAPI,
+    db: AsyncDatabase,
+    credentials: Iterable[Tuple[str, str]],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    on_progress: Optional[ProgressCallback] = None,
+    progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    job_id: Optional[int] = None,
+    completed: Optional[Dict[int, ImportRowResult]] = None,
+    existing: Optional[Dict[str, str]] = None
+) -> List[ImportRowResult]:
+    """
+    Создает пользователей в Emby и записывает их в БД
+
+    Строки забираются из credentials по мере освобождения воркеров,
+    поэтому одновременно к Emby выполняется не более concurrency запросов.
+    Созданные пользователи записываются в БД пачками по DB_BATCH_SIZE.
+    Пока предохранитель Emby открыт, строки не отмечаются ошибкой:
+    воркеры ждут пробного запроса и повторяют их.
+
+    Args:
+        emby_api: Асинхронный клиент Emby
+        db: База данных
+        credentials: Пары (имя пользователя, пароль)
+        concurrency: Максимальное число одновременных запросов к Emby
+        on_progress: Корутина (обработано, создано, ошибок), вызывается раз в progress_interval секунд
+        progress_interval: Интервал отчетов о прогрессе в секундах
+        job_id: Задание импорта, в import_rows которого сохраняется результат каждой строки
+        completed: Уже обработанные строки задания {номер строки: результат}, они пропускаются
+        existing: Снимок пользователей Emby {имя: ID}: такие пользователи не создаются
+            повторно, а считаются созданными (строки, отправленные до перезапуска)
+
+    Returns:
+        Результаты по каждой строке в исходном порядке
+    """
+    completed = completed or {}
+    results: List[ImportRowResult] = list(completed.values())
+    created_rows: List[Tuple[str, str]] = []
+    recorded_rows: List[ImportRowResult] = []
+    rows = ((row, values) for row, values in enumerate(credentials, 1) if row not in completed)
+
+    async def flush():
+        # Пачки забираются до ожидания записи, чтобы другие воркеры копили следующие
+        created, recorded = created_rows[:], recorded_rows[:]
+        created_rows.clear()
+        recorded_rows.clear()
+        if created:
+            await db.add_emby_users(created)
+        if recorded and job_id is not None:
+            await db.record_import_rows(job_id, recorded)
+
+    async def record(result: ImportRowResult):
+        results.append(result)
+        recorded_rows.append(result)
+        if result.ok:
+            created_rows.append((result.username, result.emby_user_id))
+        if len(recorded_rows) >= DB_BATCH_SIZE:
+            await flush()
+
+    async def create_when_available(username: str, password: str):
+        # Строка, которую не отправили из-за открытого предохранителя, не считается
+        # ошибкой: воркер ждет пробного запроса и повторяет ее, а задание остается running
+        while True:
+            try:
+                return await emby_api.create_user(username, password)
+            except EmbyUnavailableError:
+                delay = max(emby_api.breaker.retry_after(), MIN_UNAVAILABLE_DELAY)
+                logger.warning(f"⏸ Emby недоступен, создание {username} повторится через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    async def worker():
+        for row, (username, password) in rows:
+            if existing and username in existing:
+                await record(ImportRowResult(row, username, existing[username], None))
+                continue
+            user_data = await create_when_available(username, password)
+            if user_data:
+                await record(ImportRowResult(row, username, user_data.get('Id'), None))
+            else:
+                await record(ImportRowResult(row, username, None, "ошибка создания в Emby"))
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(progress_interval)
+            created = sum(1 for r in results if r.ok)
+            try:
+                await on_progress(len(results), created, len(results) - created)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось отправить прогресс импорта: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, concurrency))]
+    progress_task = asyncio.create_task(reporter()) if on_progress else None
+
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        if progress_task:
+            progress_task.cancel()
+        await flush()
+
+    results.sort(key=lambda r: r.row)
+    logger.info(f"📊 Импорт завершен: {sum(1 for r in results if r.ok)} из {len(results)} создано")
+    return results